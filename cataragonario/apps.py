@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class CataragonarioConfig(AppConfig):
     name = 'cataragonario'
+
+    def ready(self):
+        from . import cache  # noqa: F401 (connect its signal receivers)
+        from .lookups import register_lookups
+        register_lookups()
@@ -0,0 +1,163 @@
+"""
+Cache of the responses of the words API.
+
+Responses are stored under the current lexicon version which is bumped by
+the commands which modify the lexicon (`importmultivariation`, `init_project`)
+so all of them are invalidated at once. Size and TTL bounds are the ones of
+the cache (Django CACHES setting, e.g. OPTIONS MAX_ENTRIES and TIMEOUT) selected
+by CATARAGONARIO_CACHE.
+
+The lexicon version is the timestamp of its last modification stored on the
+database (`models.LexiconRevision`) so every process (web workers, huey
+consumer, management commands) shares it. Words and entries saved or deleted
+one by one (e.g. admin) bump it once their transaction is committed. It is also used by HTTP conditional
+requests (ETag & Last-Modified headers) so clients and proxies can cache them.
+"""
+import hashlib
+import json
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.cache import get_conditional_response, patch_vary_headers, quote_etag
+from django.utils.http import http_date
+from linguatec_lexicon.models import Entry, Word
+from rest_framework.response import Response
+
+from cataragonario import get_version
+from cataragonario.models import LexiconRevision
+
+VERSION_KEY = 'cataragonario:lexicon-version'
+
+# seconds the lexicon version read from the database is cached
+VERSION_TIMEOUT = 5
+
+# state of the bumps of words and entries changes (see `lexicon_changed`)
+_changes = threading.local()
+
+# query params which change a search response
+RESPONSE_KEY_PARAMS = ('q', 'l', 'mode', 'limit', 'offset', 'pagination', 'cursor')
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATARAGONARIO_CACHE', 'default')]
+
+
+def get_lexicon_version():
+    """Return the lexicon version: timestamp (seconds) of its last modification (0 if never modified)."""
+    cache = get_cache()
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        version = LexiconRevision.objects.values_list('version', flat=True).first() or 0
+        cache.set(VERSION_KEY, version, timeout=getattr(settings, 'CATARAGONARIO_VERSION_TIMEOUT', VERSION_TIMEOUT))
+    return version
+
+
+def bump_lexicon_version():
+    """
+    Invalidate the cached responses: call it after modifying the lexicon,
+    inside the same transaction so the new version is committed with data.
+    """
+    with transaction.atomic():
+        revision, _ = LexiconRevision.objects.select_for_update().get_or_create(pk=1)
+        # current time but always a new version (e.g. several imports on the same second)
+        revision.version = max(int(time.time()), revision.version + 1)
+        revision.save(update_fields=['version'])
+
+    # other processes see it once their cached version expires (CATARAGONARIO_VERSION_TIMEOUT)
+    get_cache().delete(VERSION_KEY)
+    transaction.on_commit(lambda: get_cache().delete(VERSION_KEY))
+    return revision.version
+
+
+@contextmanager
+def suspend_lexicon_changes():
+    """
+    Don't bump the version on every word or entry saved or deleted (e.g. by
+    the importer): the caller bumps it once all of them are done.
+    """
+    previous = getattr(_changes, 'suspended', False)
+    _changes.suspended = True
+    try:
+        yield
+    finally:
+        _changes.suspended = previous
+
+
+@receiver(post_save, sender=Word)
+@receiver(post_save, sender=Entry)
+@receiver(post_delete, sender=Word)
+@receiver(post_delete, sender=Entry)
+def lexicon_changed(sender, **kwargs):
+    if getattr(_changes, 'suspended', False):
+        return
+    # a single bump per transaction: the other callbacks find it done
+    _changes.pending = True
+    transaction.on_commit(bump_pending_lexicon_version)
+
+
+def bump_pending_lexicon_version():
+    if getattr(_changes, 'pending', False):
+        _changes.pending = False
+        bump_lexicon_version()
+
+
+def get_response_key(request, action):
+    params = [request.query_params.get(name) for name in RESPONSE_KEY_PARAMS]
+    # hyperlinks of the responses include the host
+    value = json.dumps([request.scheme, request.get_host(), action, params])
+    return 'cataragonario:response:' + hashlib.md5(value.encode('utf-8')).hexdigest()
+
+
+def cache_response(view_method):
+    """Decorate a viewset action to cache its successful responses."""
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        cache = get_cache()
+        key = get_response_key(request, self.action)
+        version = get_lexicon_version()
+
+        data = cache.get(key, version=version)
+        if data is not None:
+            return Response(data)
+
+        response = view_method(self, request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, version=version)
+        return response
+
+    return wrapper
+
+
+def get_etag(request, version):
+    # representation depends on the URL (including host of hyperlinks) and the renderer (e.g. JSON or HTML)
+    value = json.dumps([version, get_version(), request.build_absolute_uri(), request.accepted_media_type])
+    return quote_etag(hashlib.md5(value.encode('utf-8')).hexdigest())
+
+
+def conditional_response(view_method):
+    """
+    Decorate a viewset action to add ETag & Last-Modified headers (based on
+    the lexicon version) and answer 304 (Not Modified) when revalidated.
+    """
+    @wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        version = get_lexicon_version()
+        etag = get_etag(request, version)
+
+        response = get_conditional_response(request, etag=etag, last_modified=version)
+        if response is None:
+            response = view_method(self, request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(version)
+            patch_vary_headers(response, ['Accept'])
+        return response
+
+    return wrapper
@@ -0,0 +1,21 @@
+"""
+Lookups registered by the app (see `apps.CataragonarioConfig.ready`) so
+they don't require `django.contrib.postgres` on INSTALLED_APPS (nor psycopg2).
+"""
+from django.db.models import CharField, Lookup, TextField
+
+
+class TrigramSimilar(Lookup):
+    """Same as `django.contrib.postgres` one: pg_trgm `%` operator (see `search.similarity_threshold`)."""
+    lookup_name = 'trigram_similar'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return '%s %%%% %s' % (lhs, rhs), lhs_params + rhs_params
+
+
+def register_lookups():
+    for field_class in (CharField, TextField):
+        if 'trigram_similar' not in field_class.get_lookups():
+            field_class.register_lookup(TrigramSimilar)
@@ -1,12 +1,58 @@
+import argparse
+import csv
+import gzip
+import hashlib
+import json
+import multiprocessing
 import os
+import pprint
 import sys
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice, repeat
 
 from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 from linguatec_lexicon.models import DiatopicVariation, Entry, GramaticalCategory, Lexicon, Region, Word
 from linguatec_lexicon.validators import validate_balanced_parenthesis
 from openpyxl import load_workbook
 
+from cataragonario import reports
+from cataragonario.cache import bump_lexicon_version, suspend_lexicon_changes
+from cataragonario.models import update_search_keys
+from cataragonario.search import rebuild_search_index
+
+DEFAULT_BATCH_SIZE = 1000
+
+# the regions column has a few hundred distinct values repeated across the rows
+REGIONS_CACHE_SIZE = 1024
+
+# supported input formats: extension -> CSV delimiter (None for Excel documents)
+INPUT_FORMATS = {
+    '.xlsx': None,
+    '.csv': ',',
+    '.tsv': '\t',
+}
+
+ATOMIC_IMPORT = 'import'
+ATOMIC_WORKSHEET = 'worksheet'
+
+# lines [start, end) of a worksheet (by index) imported by `--chunk`
+Chunk = namedtuple('Chunk', ['worksheet', 'start', 'end'])
+
+
+def parse_chunk(value):
+    try:
+        worksheet, start, end = (int(v) for v in value.split(':'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected WORKSHEET:START:END (e.g. 0:2:1002).")
+    if worksheet < 0 or start < 1 or end <= start:
+        raise argparse.ArgumentTypeError("Invalid chunk '{}'.".format(value))
+    return Chunk(worksheet, start, end)
+
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
@@ -16,31 +62,116 @@ class Command(BaseCommand):
             '--extract-regions', action='store_true', dest='extract_regions',
             help="Extract regions from input file.",
         )
+        parser.add_argument(
+            '--batch-size', type=int, default=DEFAULT_BATCH_SIZE, dest='batch_size',
+            help="Number of rows written to the database at once (0 saves row by row).",
+        )
+        parser.add_argument(
+            '--atomic', nargs='?', const=ATOMIC_IMPORT, choices=[ATOMIC_IMPORT, ATOMIC_WORKSHEET], dest='atomic',
+            help="Run the import in a single transaction and don't save any value if there are errors. "
+                 "With 'worksheet' only the worksheets with errors are rolled back.",
+        )
+        parser.add_argument(
+            '--dry-run', action='store_true', dest='dry_run',
+            help="Only validate the input file and report what would be created (nothing is saved).",
+        )
+        parser.add_argument(
+            '--jobs', type=int, default=1, dest='jobs',
+            help="Number of processes used to clean worksheets in parallel.",
+        )
+        parser.add_argument(
+            '--incremental', action='store_true', dest='incremental',
+            help="Only create, update or delete the entries that differ from the input file.",
+        )
+        parser.add_argument(
+            '--report', dest='report',
+            help="Write errors and summary to this file as JSON Lines.",
+        )
+        parser.add_argument(
+            '--chunk', type=parse_chunk, dest='chunk',
+            help="Only import lines START (included) to END (excluded) of the worksheet with index WORKSHEET "
+                 "(format WORKSHEET:START:END). Lexicon caches are not refreshed and the report has no summary: "
+                 "the caller finishes the import.",
+        )
+        parser.add_argument(
+            '--progress', dest='progress',
+            help="Write the progress (rows, errors, worksheet, rows/sec) to this JSON file while importing.",
+        )
 
     def handle(self, *args, **options):
         self.input_file = options['input_file']
         self.verbosity = options['verbosity']
+        self.batch_size = options['batch_size']
+        self.atomic = options['atomic']
+        self.drop = options['drop']
+        self.dry_run = options['dry_run']
+        self.jobs = options['jobs']
+        self.incremental = options['incremental']
+        self.chunk = options['chunk']
+        self.next_chunk = None
+        self.validate_options()
 
         self.validate_input_file()
         self.lexicon = Lexicon.objects.get(name='castellano-catalán')
-
-        if options['drop']:
-            self.drop_existing_data()
+        self.reference = ReferenceData()
 
         if options['extract_regions']:
             self.extract_regions_from_spreadsheet()
             sys.exit(0)
 
-        self.populate_models()
+        # chunks of the same import share the report
+        self.report = reports.ReportWriter(options['report'], mode='a' if self.chunk else 'w') \
+            if options['report'] else None
+        self.progress = reports.ProgressWriter(options['progress']) if options['progress'] else None
+        self.worksheet = None
+        try:
+            # the version is bumped once by the import (see `populate_models` and `tasks.import_chunk`)
+            with suspend_lexicon_changes():
+                self.populate_models()
+            self.write_summary()
+        except Exception as e:
+            # e.g. corrupted input file: report it before publishing that the import is done
+            if self.report is not None:
+                self.report.write(reports.FATAL, message=get_error_message(e))
+            raise
+        finally:
+            self.report_progress(done=True)
+            if self.report is not None:
+                self.report.close()
+
+    def report_progress(self, done=False):
+        if self.progress is not None:
+            self.progress.update(self.rows, self.rows_errors, self.worksheet, done=done)
+
+    def write_summary(self):
         self.stdout.write("ES: {}   CAT: {}     FRANJA: {}".format(self.es, self.cat, self.aralan))
         self.stdout.write("rows: {}     errors: {}".format(self.rows, self.rows_errors))
+        if self.dry_run:
+            self.stdout.write("-- DRY RUN: no data has been saved --")
         self.stdout.write("-- THE END! --")
 
+        # summary of a chunk isn't the one of the import (see `tasks.write_import_summary`)
+        if self.report is not None and self.chunk is None:
+            self.report.write(
+                reports.SUMMARY, es=self.es, cat=self.cat, franja=self.aralan,
+                rows=self.rows, errors=self.rows_errors, dry_run=self.dry_run,
+            )
+
+    def validate_options(self):
+        if self.incremental and self.drop:
+            raise CommandError("--incremental and --drop cannot be used together.")
+        if self.incremental and self.chunk:
+            raise CommandError("--incremental requires the whole input file (cannot be used with --chunk).")
+        if self.drop and self.chunk and (self.chunk.worksheet, self.chunk.start) > (0, 2):
+            raise CommandError("--drop can only be used with the first chunk.")
+
     def validate_input_file(self):
-        _, file_extension = os.path.splitext(self.input_file)
-        if file_extension.lower() != '.xlsx':
+        file_extension, compressed = split_file_extension(self.input_file)
+        if file_extension not in INPUT_FORMATS or (compressed and file_extension == '.xlsx'):
             raise CommandError(
-                'Unexpected filetype "{}". Should be an Excel document (XLSX)'.format(file_extension))
+                'Unexpected filetype "{}". Should be an Excel document (XLSX) '
+                'or a CSV/TSV file (optionally gzip compressed)'.format(file_extension))
+        self.delimiter = INPUT_FORMATS[file_extension]
 
         if not os.path.exists(self.input_file):
             raise CommandError(
@@ -52,61 +183,102 @@ class Command(BaseCommand):
         Entry.objects.all().delete()
 
     def populate_models(self):
-        worksheets = self.load_worksheets()
         self.es = 0
         self.cat = 0
         self.aralan = 0
         self.rows = 0
         self.rows_errors = 0
-        for ws in worksheets:
-            for i, row in enumerate(ws.values):
-                try:
-                    row = self.clean_row(i + 1, row, ws.title)
-                except EmptyRow:
-                    continue
-                except ValidationError as e:
-                    # TODO(@slamora): don't save any value if there are errors
-                    self.rows_errors += 1
-                    continue
+        self.writer = self.get_writer()
+
+        with self.atomic_block(ATOMIC_IMPORT, "import"):
+            if self.drop and not self.dry_run:
+                self.drop_existing_data()
+
+            for title, rows in self.clean_worksheets():
+                self.worksheet = title
+                with self.atomic_block(ATOMIC_WORKSHEET, "worksheet {}".format(title)):
+                    self.populate_worksheet(rows)
+
+            if self.incremental:
+                self.apply_delta()
+
+            if not self.dry_run:
+                update_search_keys(self.batch_size or DEFAULT_BATCH_SIZE)
+                if self.chunk is None:
+                    # committed (or rolled back) together with the rows
+                    bump_lexicon_version()
+
+        if not self.dry_run and self.chunk is None:
+            rebuild_search_index()
+
+    def apply_delta(self):
+        if self.rows_errors:
+            # a partial input would delete the entries of the rows with errors
+            self.stderr.write("Incremental import aborted: {} rows with errors, no data saved.".format(
+                self.rows_errors))
+            return
 
+        self.writer.apply()
+        self.stdout.write("UPDATED: {}     DELETED: {}".format(self.updated, self.deleted))
+
+    def get_writer(self):
+        if self.incremental:
+            return DeltaWriter(self, self.batch_size or DEFAULT_BATCH_SIZE, dry_run=self.dry_run)
+        if self.dry_run:
+            return BulkWriter(self, self.batch_size or DEFAULT_BATCH_SIZE, dry_run=True, existing=not self.drop)
+        if self.batch_size > 0:
+            return BulkWriter(self, self.batch_size)
+        return None
+
+    def populate_worksheet(self, rows):
+        for row in rows:
+            if row.errors:
+                self.write_row_errors(row)
+                self.rows_errors += 1
+            else:
                 self.rows += 1
-                self.save_row(row)
+                if self.writer is None:
+                    self.save_row(row)
+                else:
+                    self.writer.add(row)
+            self.report_progress()
 
-    def extract_regions_from_spreadsheet(self):
+        if self.writer is not None:
+            self.writer.flush()
 
-        def extract_r(ws):
-            regions = []
-            for i, row in enumerate(ws.values):
-                # skip first row because contains headers
-                # skip empty rows
-                if i == 0 or not any(row):
-                    continue
-
-                try:
-                    row = RowEntry(row, line_number=i + 1)
-                    row.clean()
-                except ValidationError:
-                    import pprint
-                    msg = pprint.pformat(row.errors)
-                    self.stderr.write(msg)
-                    # raise
+    @contextmanager
+    def atomic_block(self, mode, name):
+        """
+        Wrap the block in a transaction (or a savepoint if nested) when `mode`
+        is the requested one and roll it back if any row has errors.
+        """
+        if self.atomic != mode:
+            yield
+            return
 
-                regions += row.regions
+        rows_errors = self.rows_errors
+        counters = (self.es, self.cat, self.aralan)
+        with transaction.atomic():
+            yield
+            if self.rows_errors > rows_errors:
+                transaction.set_rollback(True)
+                self.es, self.cat, self.aralan = counters
+                self.stderr.write("ROLLBACK {}: {} rows with errors, no data saved.".format(
+                    name, self.rows_errors - rows_errors))
 
+    def extract_regions_from_spreadsheet(self):
+        global_regions = {}
+        for _, rows in self.clean_worksheets():
             regions_grouped = {}
-            for region, cities in regions:
-                if region not in regions_grouped:
-                    regions_grouped[region] = set()
-                regions_grouped[region].update(set(cities))
+            for row in rows:
+                if row.errors:
+                    self.stderr.write(pprint.pformat(row.errors))
 
-            self.stdout.write(pprint.pformat(regions_grouped))
-
-            return regions_grouped
+                for region, cities in row.regions or []:
+                    regions_grouped.setdefault(region, set()).update(cities)
 
-        global_regions = {}
-        for ws in self.load_worksheets():
-            z = extract_r(ws)
-            global_regions.update(z)
+            self.stdout.write(pprint.pformat(regions_grouped))
+            global_regions.update(regions_grouped)
 
         return global_regions
 
@@ -119,33 +291,66 @@ class Command(BaseCommand):
         return wb.worksheets[0]
 
     def load_worksheets(self):
+        if self.delimiter is not None:
+            return [CSVWorksheet(self.input_file, self.delimiter)]
+
         wb = load_workbook(filename=self.input_file, read_only=True)
         return wb.worksheets
 
-    def clean_row(self, line_number, row, worksheet):
-        if line_number == 1:
-            raise EmptyRow('Skip header')    # skip first row because contains headers
+    def clean_worksheets(self):
+        """
+        Yield (title, rows) of every worksheet in order. With `--jobs` the
+        worksheets are cleaned by a pool of processes while this one saves
+        the rows of the previous ones.
+        """
+        if self.chunk is not None:
+            yield from self.clean_chunk()
+            return
 
-        try:
-            row = RowEntry(row, line_number=line_number, worksheet=worksheet)
-            row.clean()
-        except EmptyRow:
-            raise
-        except ValidationError:
-            for error in row.errors:
-                self.stderr.write(
-                    "{:>8}.{:<4}: {:<15} {:<2} {:<10}".format(
-                        worksheet, line_number, error["word"], error["column"], error["message"])
-                )
-            raise
-        # handle another kind of errors
-        except Exception as e:
+        if self.jobs <= 1 or self.delimiter is not None:
+            for ws in self.load_worksheets():
+                yield ws.title, clean_worksheet(ws, self.reference)
+            return
+
+        wb = load_workbook(filename=self.input_file, read_only=True)
+        titles = wb.sheetnames
+        wb.close()
+
+        # workers are forked so they inherit the reference data (and never query the database)
+        with ProcessPoolExecutor(
+                max_workers=self.jobs, mp_context=multiprocessing.get_context('fork'),
+                initializer=init_worker, initargs=(self.reference,)) as executor:
+            jobs = executor.map(clean_worksheet_job, repeat(self.input_file), range(len(titles)))
+            yield from zip(titles, jobs)
+
+    def clean_chunk(self):
+        """
+        Yield (title, rows) of the lines of the chunk and set `next_chunk`
+        (None when the chunk is the last one of the input file).
+        """
+        worksheets = self.load_worksheets()
+        if self.chunk.worksheet >= len(worksheets):
+            return
+
+        ws = worksheets[self.chunk.worksheet]
+        lines = enumerate(ws.values, start=1)
+        yield ws.title, clean_worksheet(ws, self.reference, islice(lines, self.chunk.start - 1, self.chunk.end - 1))
+
+        # rows have been consumed (saved) before resuming
+        size = self.chunk.end - self.chunk.start
+        if next(lines, None) is not None:
+            self.next_chunk = Chunk(self.chunk.worksheet, self.chunk.end, self.chunk.end + size)
+        elif self.chunk.worksheet + 1 < len(worksheets):
+            self.next_chunk = Chunk(self.chunk.worksheet + 1, 2, 2 + size)
+
+    def write_row_errors(self, row):
+        for error in row.errors:
             self.stderr.write(
                 "{:>8}.{:<4}: {:<15} {:<2} {:<10}".format(
-                    worksheet, line_number, error["word"], "", str(e))
+                    row.worksheet, row.line_number, error["word"], error["column"], error["message"])
             )
-
-        return row
+            if self.report is not None:
+                self.report.write(reports.ERROR, worksheet=row.worksheet, line=row.line_number, **error)
 
     def save_row(self, row):
         gramcats = row.gramcats
@@ -173,64 +378,253 @@ class Command(BaseCommand):
                     entry.gramcats.set(gramcats)
                     self.aralan += 1
                 elif not cat_created and not created:
-                    # DB structure relation between `es` <--> `cat variation` and it doesn't take in account
-                    # column D of Excel (normative catalan). So some rows are marked as duplicated.
-                    # This could be ignored without because any data is losed.
-                    if self.verbosity > 2:
-                        msg = f"Possible duplicated row (unique-entry): {row.term} ({variation}) // {cat_term}"
-                        self.stderr.write(
-                            "{:>8}.{:<4}: {:<15} {:<2} {:<10}".format(
-                                row.worksheet, row.line_number, word.term, "", msg)
-                            )
+                    self.warn_duplicated_row(row, word.term, cat_term, variation)
+
+    def warn_duplicated_row(self, row, term, cat_term, variation):
+        # DB structure relation between `es` <--> `cat variation` and it doesn't take in account
+        # column D of Excel (normative catalan). So some rows are marked as duplicated.
+        # This could be ignored without because any data is losed.
+        if self.verbosity > 2:
+            msg = f"Possible duplicated row (unique-entry): {row.term} ({variation}) // {cat_term}"
+            self.stderr.write(
+                "{:>8}.{:<4}: {:<15} {:<2} {:<10}".format(
+                    row.worksheet, row.line_number, term, "", msg)
+                )
+
+
+class BulkWriter:
+    """
+    Buffer cleaned rows and write them in batches using set based queries.
+    Each batch replays `Command.save_row` in memory (so counters and warnings
+    are the same) and then creates Words, Entries and their gramcats using
+    `bulk_create` instead of several queries per cell.
+
+    On `dry_run` nothing is written: planned values are kept in memory so
+    the counters report what would be created. Without `existing` the stored
+    words and entries are ignored (e.g. dry run of `--drop`).
+    """
+
+    def __init__(self, command, batch_size, dry_run=False, existing=True):
+        self.command = command
+        self.lexicon = command.lexicon
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.existing = existing
+        self.rows = []
+        self.pending_words = set()
+        self.pending_entries = set()
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        rows, self.rows = self.rows, []
+        self.words = set(self.pending_words)
+        self.entries = set(self.pending_entries)
+        if self.existing:
+            terms = {es_term for row in rows for es_term in row.es}
+            self.words.update(
+                Word.objects.filter(lexicon=self.lexicon, term__in=terms).values_list('term', flat=True)
+            )
+            self.entries.update(
+                Entry.objects.filter(word__lexicon=self.lexicon, word__term__in=terms).values_list(
+                    'word__term', 'translation', 'variation_id')
+            )
+        self.new_words = []
+        self.new_entries = {}   # (term, translation, variation_id) -> gramcats
+
+        for row in rows:
+            self.plan_row(row)
+
+        if self.dry_run:
+            self.pending_words.update(self.new_words)
+            self.pending_entries.update(self.new_entries)
+        else:
+            self.write()
+
+    def plan_row(self, row):
+        for es_term in row.es:
+            created = self.plan_word(es_term)
+            if created:
+                self.command.es += 1
+
+            for cat_term in row.cat:
+                cat_created = self.plan_entry((es_term, cat_term, None), row.gramcats)
+                if cat_created:
+                    self.command.cat += 1
+
+            for variation in row.variations:
+                if self.plan_entry((es_term, row.term, variation.id), row.gramcats):
+                    self.command.aralan += 1
+                elif not cat_created and not created:
+                    self.command.warn_duplicated_row(row, es_term, cat_term, variation)
+
+    def plan_word(self, term):
+        if term in self.words:
+            return False
+        self.words.add(term)
+        self.new_words.append(term)
+        return True
+
+    def plan_entry(self, key, gramcats):
+        if key in self.entries:
+            return False
+        self.entries.add(key)
+        self.new_entries[key] = {gramcat.id for gramcat in gramcats}
+        return True
+
+    def write(self):
+        Word.objects.bulk_create(
+            [Word(lexicon=self.lexicon, term=term) for term in self.new_words], batch_size=self.batch_size)
+
+        terms = {term for term, _, _ in self.new_entries}
+        word_ids = dict(Word.objects.filter(lexicon=self.lexicon, term__in=terms).values_list('term', 'id'))
+        Entry.objects.bulk_create([
+            Entry(word_id=word_ids[term], translation=translation, variation_id=variation_id)
+            for term, translation, variation_id in self.new_entries
+        ], batch_size=self.batch_size)
+
+        # retrieve ids because not every database backend set them on bulk_create
+        entry_ids = {}
+        for pk, *key in Entry.objects.filter(word_id__in=word_ids.values()).values_list(
+                'id', 'word__term', 'translation', 'variation_id'):
+            entry_ids[tuple(key)] = pk
+
+        EntryGramcat = Entry.gramcats.through
+        EntryGramcat.objects.bulk_create([
+            EntryGramcat(entry_id=entry_ids[key], gramaticalcategory_id=gramcat_id)
+            for key, gramcats in self.new_entries.items() for gramcat_id in gramcats
+        ], batch_size=self.batch_size)
+
+
+class DeltaWriter(BulkWriter):
+    """
+    Compare the input file with the stored entries of the lexicon and only
+    write the difference. Entries are identified by (es, translation,
+    variation) and fingerprinted by their gramcats, so new ones are created,
+    missing ones deleted and changed ones get their gramcats updated.
+    """
+
+    def __init__(self, command, batch_size, dry_run=False):
+        super().__init__(command, batch_size, dry_run=dry_run)
+        self.command.updated = 0
+        self.command.deleted = 0
+        self.words = set()
+        self.entries = set()
+        self.new_words = []
+        self.new_entries = {}
+
+    def add(self, row):
+        # keep the same semantics of `Command.save_row`: gramcats of first row win
+        for es_term in row.es:
+            self.plan_word(es_term)
+            for cat_term in row.cat:
+                self.plan_entry((es_term, cat_term, None), row.gramcats)
+            for variation in row.variations:
+                self.plan_entry((es_term, row.term, variation.id), row.gramcats)
+
+    def flush(self):
+        # difference can only be computed when the whole input has been read
+        pass
+
+    def apply(self):
+        expected_words, expected_entries = self.new_words, self.new_entries
+        stored_words = set(self.lexicon.words.values_list('term', flat=True))
+        stored_entries = self.load_stored_entries()
+
+        self.new_words = [term for term in expected_words if term not in stored_words]
+        self.new_entries = {
+            key: gramcats for key, gramcats in expected_entries.items() if key not in stored_entries
+        }
+        changed = {
+            pk: expected_entries[key] for key, (pk, gramcats) in stored_entries.items()
+            if key in expected_entries and expected_entries[key] != gramcats
+        }
+        removed_words = stored_words.difference(expected_words)
+        removed_entries = [pk for key, (pk, _) in stored_entries.items() if key not in expected_entries]
+
+        self.command.es += len(self.new_words)
+        self.command.cat += len([key for key in self.new_entries if key[2] is None])
+        self.command.aralan += len([key for key in self.new_entries if key[2] is not None])
+        self.command.updated += len(changed)
+        self.command.deleted += len(removed_entries)
+
+        if not self.dry_run:
+            with transaction.atomic():
+                Entry.objects.filter(pk__in=removed_entries).delete()
+                self.lexicon.words.filter(term__in=removed_words).delete()
+                self.update_gramcats(changed)
+                self.write()
+
+    def load_stored_entries(self):
+        """Return {(term, translation, variation_id): (entry_id, gramcats)} of the lexicon."""
+        entries = {}
+        for pk, term, translation, variation_id, gramcat_id in Entry.objects.filter(
+                word__lexicon=self.lexicon).values_list(
+                'id', 'word__term', 'translation', 'variation_id', 'gramcats__id'):
+            _, gramcats = entries.setdefault((term, translation, variation_id), (pk, set()))
+            if gramcat_id is not None:
+                gramcats.add(gramcat_id)
+        return entries
+
+    def update_gramcats(self, changed):
+        EntryGramcat = Entry.gramcats.through
+        EntryGramcat.objects.filter(entry_id__in=changed.keys()).delete()
+        EntryGramcat.objects.bulk_create([
+            EntryGramcat(entry_id=pk, gramaticalcategory_id=gramcat_id)
+            for pk, gramcats in changed.items() for gramcat_id in gramcats
+        ], batch_size=self.batch_size)
 
 
 def extract_regions(value):
     if value is None:
         return [('franja', ['general'])]
 
+    # copy cached values because callers could modify them
+    return [(region, list(variants)) for region, variants in tokenize_regions(value)]
+
+
+@lru_cache(maxsize=REGIONS_CACHE_SIZE)
+def tokenize_regions(value):
+    """
+    Split value into (region, variants) tuples in a single pass.
+    Regions are separated by commas outside parenthesis and variants are
+    the comma separated values of the first parenthesis of each region.
+    """
     value = value.strip().lower()
     validate_balanced_parenthesis(value)
 
-    comma_position = value.find(",")
     regions = []
-    if comma_position == -1:
-        extracted_region = split_region_and_variants(value)
-    else:
-        parenthesis_beg_position = value.find("(")
-        parenthesis_end_position = value.find(")")
-        if comma_position > parenthesis_beg_position and comma_position < parenthesis_end_position:
-            extracted_region = split_region_and_variants(value)
-            next_comma_position = value.find(",", parenthesis_end_position)
-            if next_comma_position == -1:
-                raw = ''
-            else:
-                raw = value[next_comma_position + 1:]
-        else:
-            region_left = value[:comma_position]
-            extracted_region = split_region_and_variants(region_left)
-            raw = value[comma_position + 1:]
-
-        if raw:
-            regions += extract_regions(raw)
-
-    regions = [extracted_region] + regions
+    start, opened, closed, depth = 0, None, None, 0
+    for position, char in enumerate(value):
+        if char == '(':
+            opened = position if opened is None else opened
+            depth += 1
+        elif char == ')':
+            closed = position if closed is None else closed
+            depth -= 1
+        elif char == ',' and depth == 0:
+            regions.append(split_region_and_variants(value, start, position, opened, closed))
+            start, opened, closed = position + 1, None, None
 
-    return regions
+    # a trailing comma doesn't start a new region
+    if start < len(value) or not regions:
+        regions.append(split_region_and_variants(value, start, len(value), opened, closed))
 
+    return tuple(regions)
 
-def split_region_and_variants(value):
-    parenthesis_beg_position = value.find("(")
-    parenthesis_end_position = value.find(")")
 
-    if parenthesis_beg_position == -1:
-        region = value
-        variants = []
-    else:
-        region = value[:parenthesis_beg_position]
-        variants = value[parenthesis_beg_position + 1:parenthesis_end_position]
-        variants = split_and_strip(variants)
+def split_region_and_variants(value, start, end, opened, closed):
+    if opened is None:
+        return (value[start:end].strip(), ())
 
-    return (region.strip(), variants)
+    variants = split_and_strip(value[opened + 1:closed])
+    return (value[start:opened].strip(), tuple(variants))
 
 
 def extract_variants(value):
@@ -245,20 +639,163 @@ def split_and_strip(value):
     return [item.strip() for item in value.split(',')]
 
 
+def split_file_extension(filename):
+    """Return the (lowercase) extension of the file and if it's gzip compressed."""
+    name = filename.lower()
+    compressed = name.endswith('.gz')
+    if compressed:
+        name = name[:-len('.gz')]
+    _, file_extension = os.path.splitext(name)
+    return file_extension, compressed
+
+
+class CSVWorksheet:
+    """
+    Read a CSV/TSV file (optionally gzip compressed) as if it was a worksheet
+    with the same columns. Rows are read lazily to keep memory usage constant.
+    """
+    NUMBER_OF_COLUMNS = 5   # same as RowEntry.fields
+
+    def __init__(self, filename, delimiter):
+        self.filename = filename
+        self.delimiter = delimiter
+        self.title = os.path.basename(filename).split('.')[0]
+
+    def open(self):
+        _, compressed = split_file_extension(self.filename)
+        opener = gzip.open if compressed else open
+        return opener(self.filename, mode='rt', encoding='utf-8-sig', newline='')
+
+    @property
+    def values(self):
+        with self.open() as f:
+            for row in csv.reader(f, delimiter=self.delimiter):
+                # behave like openpyxl: empty cells are None
+                row = [value if value != '' else None for value in row[:self.NUMBER_OF_COLUMNS]]
+                row += [None] * (self.NUMBER_OF_COLUMNS - len(row))
+                yield tuple(row)
+
+
+def get_error_message(exception):
+    if isinstance(exception, CommandError):
+        return str(exception)
+    return "{}: {}".format(type(exception).__name__, exception)
+
+
+def clean_worksheet(ws, reference, lines=None):
+    """
+    Yield a cleaned RowEntry for every non empty row of the worksheet (or
+    only of `lines`: (line number, values) pairs of the worksheet).
+    Invalid rows are yielded too: check `row.errors` before using them.
+    """
+    if lines is None:
+        lines = enumerate(ws.values, start=1)
+
+    for line_number, values in lines:
+        if line_number == 1:
+            continue    # skip first row because contains headers
+
+        row = RowEntry(values, line_number=line_number, worksheet=ws.title, reference=reference)
+        try:
+            row.clean()
+        except EmptyRow:
+            continue
+        except ValidationError:
+            pass
+        # handle another kind of errors
+        except Exception as e:
+            row.errors.append({"word": getattr(row, 'term', ''), "column": "", "message": str(e)})
+
+        yield row
+
+
+_worker_reference = None
+
+
+def init_worker(reference):
+    global _worker_reference
+    _worker_reference = reference
+
+
+def clean_worksheet_job(input_file, index):
+    """Clean a worksheet on a worker process (see `Command.clean_worksheets`)."""
+    wb = load_workbook(filename=input_file, read_only=True)
+    rows = list(clean_worksheet(wb.worksheets[index], _worker_reference))
+    wb.close()
+    return rows
+
+
 class EmptyRow(Exception):
     pass
 
 
+class ReferenceData:
+    """
+    In-memory lookup of gramatical categories, regions and diatopic variations.
+    All the rows are loaded once so cleaning a spreadsheet doesn't query the
+    database for every cell. Names are matched case insensitive (like `iexact`)
+    and, like `get()`, MultipleObjectsReturned is raised if several match.
+    """
+
+    def __init__(self):
+        self.gramcats = group_by_name(GramaticalCategory.objects.all(), 'abbreviation')
+        self.regions = group_by_name(Region.objects.all(), 'name')
+        self.variations = group_by_name(DiatopicVariation.objects.select_related('region'), 'name')
+
+    def get_version(self):
+        """Return a digest of the reference data (validation results depend on it)."""
+        data = [
+            sorted((g.id, g.abbreviation) for gramcats in self.gramcats.values() for g in gramcats),
+            sorted((r.id, r.name) for regions in self.regions.values() for r in regions),
+            sorted((v.id, v.name, v.region_id) for variations in self.variations.values() for v in variations),
+        ]
+        return hashlib.sha256(json.dumps(data).encode('utf-8')).hexdigest()
+
+    def get_gramcat(self, abbreviation):
+        return get_by_name(self.gramcats, GramaticalCategory, abbreviation)
+
+    def get_region(self, name):
+        return get_by_name(self.regions, Region, name)
+
+    def get_variation(self, name):
+        return get_by_name(self.variations, DiatopicVariation, name)
+
+
+def group_by_name(objects, field):
+    """Return {lowercased name: [object, ...]} keeping the objects which share a name."""
+    groups = {}
+    for obj in objects:
+        groups.setdefault(getattr(obj, field).lower(), []).append(obj)
+    return groups
+
+
+def get_by_name(groups, model, name):
+    objects = groups.get(name.lower(), [])
+    if not objects:
+        raise model.DoesNotExist(name)
+    if len(objects) > 1:
+        raise model.MultipleObjectsReturned(
+            "{} {} objects match '{}'".format(len(objects), model.__name__, name))
+    return objects[0]
+
+
 class RowEntry:
     fields = ['term', 'gramcats', 'regions', 'cat', 'es']
     default_error_messages = {
         'required': 'Required value (this column cannot be empty)',
     }
 
-    def __init__(self, row, line_number, worksheet=None) -> None:
+    def __init__(self, row, line_number, worksheet=None, reference=None) -> None:
         self.row = row
         self.line_number = line_number
         self.worksheet = worksheet
+        self.reference = reference if reference is not None else ReferenceData()
+
+    def __getstate__(self):
+        # reference data is shared by all the rows, don't copy it between processes
+        state = self.__dict__.copy()
+        state['reference'] = None
+        return state
 
     def clean(self):
         if not any(self.row):
@@ -284,11 +821,10 @@ class RowEntry:
             self.add_error("C", self.default_error_messages['required'])
             return []
 
-        # TODO(@slamora) optimize queries
         gramcats = []
         for abbr in split_and_strip(value):
             try:
-                gramcats.append(GramaticalCategory.objects.get(abbreviation=abbr))
+                gramcats.append(self.reference.get_gramcat(abbr))
             except GramaticalCategory.DoesNotExist:
                 self.add_error("B", "unkown gramatical category '{}'".format(abbr))
 
@@ -312,14 +848,14 @@ class RowEntry:
         for region, variation_names in regions:
             try:
                 # TODO(@slamora) translate code to region name
-                r = Region.objects.get(name__iexact=region)
+                r = self.reference.get_region(region)
                 if not variation_names:
                     variation_names = [r.name]
 
             except Region.DoesNotExist:
                 # if region doesn't exist, maybe it's a location
                 try:
-                    v = DiatopicVariation.objects.get(name__iexact=region)
+                    v = self.reference.get_variation(region)
                     r = v.region
                     self.variations.append(v)
                     continue
@@ -335,7 +871,7 @@ class RowEntry:
 
     def add_location_if_belongs_to_region(self, region, variation):
         try:
-            v = DiatopicVariation.objects.get(name__iexact=variation)
+            v = self.reference.get_variation(variation)
         except DiatopicVariation.DoesNotExist:
             self.add_error("C", "unkown location {}".format(variation))
         else:
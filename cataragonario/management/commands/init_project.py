@@ -1,8 +1,12 @@
 import sys
 
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from linguatec_lexicon.models import DiatopicVariation, Lexicon, Region
 
+from cataragonario.cache import bump_lexicon_version
+from cataragonario.search import rebuild_search_index
+
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
@@ -23,8 +27,11 @@ class Command(BaseCommand):
             self.fix_region_and_variation_names()
             sys.exit(0)
 
-        self.init_lexicon()
-        self.init_diatopic_variations()
+        with transaction.atomic():
+            self.init_lexicon()
+            self.init_diatopic_variations()
+            bump_lexicon_version()
+        rebuild_search_index()
 
     def drop_all(self):
         DiatopicVariation.objects.all().delete()
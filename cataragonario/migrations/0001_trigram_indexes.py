@@ -0,0 +1,42 @@
+from django.db import migrations
+
+from cataragonario.migrations._lexicon import LEXICON_DEPENDENCY
+
+# Trigram indexes used by words search & near endpoints (models belong to linguatec_lexicon)
+INDEXES = {
+    'cataragonario_word_term_trgm': 'linguatec_lexicon_word USING gin (term gin_trgm_ops)',
+    'cataragonario_entry_translation_trgm_normative':
+        'linguatec_lexicon_entry USING gin (translation gin_trgm_ops) WHERE variation_id IS NULL',
+    'cataragonario_entry_translation_trgm_dialectal':
+        'linguatec_lexicon_entry USING gin (translation gin_trgm_ops) WHERE variation_id IS NOT NULL',
+}
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    # like TrigramExtension but without importing django.contrib.postgres (requires psycopg2)
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, definition in INDEXES.items():
+        schema_editor.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {}'.format(name, definition))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name in INDEXES:
+        schema_editor.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+    schema_editor.execute('DROP EXTENSION IF EXISTS pg_trgm')
+
+
+class Migration(migrations.Migration):
+    # indexes are created concurrently to don't lock tables on big lexicons
+    atomic = False
+
+    dependencies = [
+        LEXICON_DEPENDENCY,
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
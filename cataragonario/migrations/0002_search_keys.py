@@ -0,0 +1,59 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+from cataragonario.migrations._lexicon import LEXICON_DEPENDENCY
+from cataragonario.models import fold
+
+
+def populate_search_keys(apps, schema_editor):
+    Word = apps.get_model('linguatec_lexicon', 'Word')
+    Entry = apps.get_model('linguatec_lexicon', 'Entry')
+    WordSearchKey = apps.get_model('cataragonario', 'WordSearchKey')
+    EntrySearchKey = apps.get_model('cataragonario', 'EntrySearchKey')
+
+    WordSearchKey.objects.bulk_create([
+        WordSearchKey(word_id=pk, term=fold(term)) for pk, term in Word.objects.values_list('id', 'term')
+    ], batch_size=1000)
+    EntrySearchKey.objects.bulk_create([
+        EntrySearchKey(entry_id=pk, translation=fold(translation))
+        for pk, translation in Entry.objects.values_list('id', 'translation')
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        LEXICON_DEPENDENCY,
+        ('cataragonario', '0001_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WordSearchKey',
+            fields=[
+                ('word', models.OneToOneField(
+                    on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_key',
+                    serialize=False, to='linguatec_lexicon.word')),
+                ('term', models.TextField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='EntrySearchKey',
+            fields=[
+                ('entry', models.OneToOneField(
+                    on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_key',
+                    serialize=False, to='linguatec_lexicon.entry')),
+                ('translation', models.TextField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='wordsearchkey',
+            index=models.Index(fields=['term'], name='cataragonario_word_key', opclasses=['text_pattern_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='entrysearchkey',
+            index=models.Index(
+                fields=['translation'], name='cataragonario_entry_key', opclasses=['text_pattern_ops']),
+        ),
+        migrations.RunPython(populate_search_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+from django.db import migrations
+
+from cataragonario.migrations._lexicon import LEXICON_DEPENDENCY
+
+# Index of words cursor pagination ordering (see pagination.WordCursorPagination)
+INDEX = 'cataragonario_word_term_id'
+
+
+def create_index(apps, schema_editor):
+    concurrently = 'CONCURRENTLY ' if schema_editor.connection.vendor == 'postgresql' else ''
+    schema_editor.execute('CREATE INDEX {}IF NOT EXISTS {} ON linguatec_lexicon_word (term, id)'.format(
+        concurrently, INDEX))
+
+
+def drop_index(apps, schema_editor):
+    concurrently = 'CONCURRENTLY ' if schema_editor.connection.vendor == 'postgresql' else ''
+    schema_editor.execute('DROP INDEX {}IF EXISTS {}'.format(concurrently, INDEX))
+
+
+class Migration(migrations.Migration):
+    # index is created concurrently to don't lock table on big lexicons
+    atomic = False
+
+    dependencies = [
+        LEXICON_DEPENDENCY,
+        ('cataragonario', '0002_search_keys'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cataragonario', '0003_word_term_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('input_file', models.CharField(max_length=512)),
+                ('log_file', models.CharField(max_length=512)),
+                ('drop', models.BooleanField(default=False)),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('worksheet', models.PositiveIntegerField(default=0)),
+                ('line', models.PositiveIntegerField(default=2)),
+                ('rows', models.PositiveIntegerField(default=0)),
+                ('errors', models.PositiveIntegerField(default=0)),
+                ('status', models.CharField(
+                    choices=[('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='running',
+                    max_length=16)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cataragonario', '0005_lexiconrevision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importtask',
+            name='es',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='importtask',
+            name='cat',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='importtask',
+            name='franja',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,38 @@
+"""
+Dependency of the migrations on linguatec_lexicon ones (the migration loader
+skips modules starting with underscore).
+
+It's pinned to a concrete migration instead of '__latest__', which would
+change once linguatec_lexicon ships a new migration and break the history
+of the applied ones (InconsistentMigrationHistory).
+"""
+import importlib
+import pkgutil
+
+from django.db import migrations
+
+
+def adds_entry_variation(operation):
+    if isinstance(operation, migrations.CreateModel):
+        return operation.name_lower == 'entry' and any(name == 'variation' for name, _ in operation.fields)
+    if isinstance(operation, migrations.AddField):
+        return operation.model_name_lower == 'entry' and operation.name == 'variation'
+    return False
+
+
+def find_migration(app_label, predicate):
+    """Return the (app_label, name) key of the first migration with an operation matching predicate."""
+    package = importlib.import_module('{}.migrations'.format(app_label))
+    names = sorted(
+        name for _, name, is_package in pkgutil.iter_modules(package.__path__)
+        if not is_package and name[0] not in '_~'
+    )
+    for name in names:
+        module = importlib.import_module('{}.{}'.format(package.__name__, name))
+        if any(predicate(operation) for operation in module.Migration.operations):
+            return app_label, name
+    raise LookupError("No {} migration adds Entry.variation.".format(app_label))
+
+
+# Word and Entry (with its variation) are used by the trigram indexes & search keys
+LEXICON_DEPENDENCY = find_migration('linguatec_lexicon', adds_entry_variation)
@@ -0,0 +1,107 @@
+import unicodedata
+
+from django.db import models
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from linguatec_lexicon.models import Entry, Word
+
+
+def fold(value):
+    """Return value lowercased and without accents (e.g. 'Saidí' --> 'saidi')."""
+    value = unicodedata.normalize('NFKD', value.strip().casefold())
+    return ''.join(char for char in value if not unicodedata.combining(char))
+
+
+class WordSearchKey(models.Model):
+    """Normalized (see `fold`) term of a Word used by search lookups."""
+    word = models.OneToOneField(Word, on_delete=models.CASCADE, primary_key=True, related_name='search_key')
+    term = models.TextField()
+
+    class Meta:
+        indexes = [
+            # pattern ops allow using the index on prefix (LIKE 'abc%') lookups
+            models.Index(fields=['term'], name='cataragonario_word_key', opclasses=['text_pattern_ops']),
+        ]
+
+
+class EntrySearchKey(models.Model):
+    """Normalized (see `fold`) translation of an Entry used by search lookups."""
+    entry = models.OneToOneField(Entry, on_delete=models.CASCADE, primary_key=True, related_name='search_key')
+    translation = models.TextField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['translation'], name='cataragonario_entry_key', opclasses=['text_pattern_ops']),
+        ]
+
+
+@receiver(post_save, sender=Word)
+def save_word_search_key(sender, instance, update_fields=None, **kwargs):
+    """Keep the search key of words saved outside the importer (e.g. admin)."""
+    if update_fields is None or 'term' in update_fields:
+        WordSearchKey.objects.update_or_create(word=instance, defaults={'term': fold(instance.term)})
+
+
+@receiver(post_save, sender=Entry)
+def save_entry_search_key(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or 'translation' in update_fields:
+        EntrySearchKey.objects.update_or_create(entry=instance, defaults={'translation': fold(instance.translation)})
+
+
+def update_search_keys(batch_size=1000):
+    """
+    Create the search keys of the words and entries which don't have one yet
+    (e.g. created by `bulk_create`, which doesn't send `post_save`).
+    """
+    WordSearchKey.objects.bulk_create([
+        WordSearchKey(word_id=pk, term=fold(term))
+        for pk, term in Word.objects.filter(search_key__isnull=True).values_list('id', 'term')
+    ], batch_size=batch_size)
+
+    EntrySearchKey.objects.bulk_create([
+        EntrySearchKey(entry_id=pk, translation=fold(translation))
+        for pk, translation in Entry.objects.filter(search_key__isnull=True).values_list('id', 'translation')
+    ], batch_size=batch_size)
+
+
+class LexiconRevision(models.Model):
+    """
+    Single row with the revision of the lexicon: timestamp (seconds) of its
+    last modification, shared by all the processes (see `cache`).
+    """
+    version = models.BigIntegerField(default=0)
+
+
+class ImportTask(models.Model):
+    """
+    Background import of a file (see `tasks.run_import`) done by chunks of
+    lines. The next chunk to import is committed together with the rows of
+    the previous one so the import can be resumed after a worker restart.
+    """
+    STATUS_RUNNING = 'running'
+    STATUS_DONE = 'done'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_DONE, 'Done'),
+        (STATUS_FAILED, 'Failed'),
+    )
+
+    input_file = models.CharField(max_length=512)
+    log_file = models.CharField(max_length=512)
+    drop = models.BooleanField(default=False)
+    chunk_size = models.PositiveIntegerField()
+    # next chunk: worksheet (index) and first line
+    worksheet = models.PositiveIntegerField(default=0)
+    line = models.PositiveIntegerField(default=2)
+    rows = models.PositiveIntegerField(default=0)
+    errors = models.PositiveIntegerField(default=0)
+    es = models.PositiveIntegerField(default=0)
+    cat = models.PositiveIntegerField(default=0)
+    franja = models.PositiveIntegerField(default=0)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=STATUS_RUNNING)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return "Import {} ({})".format(self.pk, self.status)
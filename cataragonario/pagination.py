@@ -0,0 +1,22 @@
+from linguatec_lexicon.views import DefaultLimitOffsetPagination
+from rest_framework.pagination import CursorPagination
+
+# query param to opt-in cursor pagination (e.g. ?pagination=cursor)
+PAGINATION_QUERY_PARAM = 'pagination'
+PAGINATION_CURSOR = 'cursor'
+
+
+class WordCursorPagination(CursorPagination):
+    """
+    Keyset pagination ordered by (term, id): every page is retrieved with
+    the same cost (no OFFSET scan) and without counting the words.
+    """
+    ordering = ('term', 'id')
+    page_size = DefaultLimitOffsetPagination.default_limit
+    page_size_query_param = DefaultLimitOffsetPagination.limit_query_param
+    max_page_size = DefaultLimitOffsetPagination.max_limit
+
+
+def use_cursor_pagination(request):
+    return (request.query_params.get(PAGINATION_QUERY_PARAM) == PAGINATION_CURSOR
+            or WordCursorPagination.cursor_query_param in request.query_params)
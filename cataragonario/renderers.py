@@ -0,0 +1,37 @@
+"""
+JSON renderer using orjson (optional dependency) which renders the same
+output than DRF JSONRenderer several times faster.
+"""
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+
+try:
+    import orjson
+except ImportError:     # pragma: no cover
+    orjson = None
+
+
+class FastJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if orjson is None or indent is not None or not self.compact or self.ensure_ascii or not self.strict:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        if data is None:
+            return b''
+
+        # types not handled by DRF encoder the same way are passed through it
+        ret = orjson.dumps(
+            data, default=self.encoder_class().default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS,
+        )
+        # like JSONRenderer, escape \u2028 and \u2029 so output is a strict javascript subset
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+def get_renderer_classes():
+    """Default renderer classes replacing JSONRenderer by FastJSONRenderer."""
+    return [
+        FastJSONRenderer if renderer_class is JSONRenderer else renderer_class
+        for renderer_class in api_settings.DEFAULT_RENDERER_CLASSES
+    ]
@@ -0,0 +1,105 @@
+"""
+Structured report of the importer written as JSON Lines (one record per line)
+so it can be read and filtered without loading the whole file in memory.
+
+The progress of a running import is published on a small JSON status file.
+"""
+import json
+import os
+import tempfile
+import time
+
+ERROR = 'error'
+SUMMARY = 'summary'
+FATAL = 'fatal'
+
+
+# seconds between progress updates
+PROGRESS_INTERVAL = 1
+
+
+def get_report_filename(log_filename):
+    return os.path.splitext(log_filename)[0] + '.jsonl'
+
+
+def get_progress_filename(log_filename):
+    return os.path.splitext(log_filename)[0] + '.progress.json'
+
+
+class ReportWriter:
+    def __init__(self, filename, mode='w'):
+        self.file = open(filename, mode, encoding='utf-8')
+
+    def write(self, record_type, **data):
+        data['type'] = record_type
+        self.file.write(json.dumps(data, ensure_ascii=False) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+def read_report(filename):
+    """Yield the records of the report one by one."""
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # last line could be partially written
+                continue
+
+
+def read_result(filename):
+    """Return the last summary or fatal record of the report (None if the import hasn't finished)."""
+    result = None
+    try:
+        for record in read_report(filename):
+            if record['type'] != ERROR:
+                result = record
+    except FileNotFoundError:
+        pass
+    return result
+
+
+class ProgressWriter:
+    """Write the import progress to the status file at most every `interval` seconds."""
+
+    def __init__(self, filename, interval=PROGRESS_INTERVAL):
+        self.filename = filename
+        self.interval = interval
+        self.started = time.monotonic()
+        self.written = None
+        self.update(rows=0, errors=0, worksheet=None)
+
+    def update(self, rows, errors, worksheet, done=False):
+        now = time.monotonic()
+        if not done and self.written is not None and now - self.written < self.interval:
+            return
+
+        elapsed = now - self.started
+        write_progress(self.filename, {
+            'rows': rows,
+            'errors': errors,
+            'worksheet': worksheet,
+            'elapsed': round(elapsed, 1),
+            'rows_per_second': round((rows + errors) / elapsed, 1) if elapsed else 0,
+            'done': done,
+        })
+        self.written = now
+
+
+def write_progress(filename, status):
+    # replace the file so readers never get a partially written status
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)))
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(status, f, ensure_ascii=False)
+    os.replace(tmp_file, filename)
+
+
+def read_progress(filename):
+    """Return the last status written by ProgressWriter (None if the import hasn't started)."""
+    try:
+        with open(filename, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
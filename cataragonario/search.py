@@ -0,0 +1,425 @@
+"""
+Search backends of the near (fuzzy) endpoint.
+
+PostgresSearchBackend computes trigram similarity on the database (pg_trgm)
+while MemorySearchBackend keeps a trigram inverted index of the lexicon in
+memory, so it works with any database and doesn't query it per search.
+
+Autocomplete is served by sorted (prefix) indexes kept in memory by both.
+"""
+import os
+import pickle
+import tempfile
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, CharField, IntegerField, Min, Q, Value, When
+from django.utils.module_loading import import_string
+from linguatec_lexicon.models import Entry, Lexicon, Word
+
+from cataragonario.cache import get_lexicon_version
+from cataragonario.models import fold
+
+MODE_DIALECTAL = 'dialectal'
+MODE_REVERSE = 'reverse'
+MODE_STANDAR = 'standar'
+
+SEARCH_MODES = (MODE_STANDAR, MODE_REVERSE, MODE_DIALECTAL)
+
+# https://www.postgresql.org/docs/current/pgtrgm.html
+# 0 means totally different
+# 1 means identical
+NEAR_MIN_SIMILARITY = 0.2
+
+# match tiers of ranked search (best first)
+MATCH_EXACT = 'exact'
+MATCH_WORD = 'word'     # query is the first word(s) of the term
+MATCH_FUZZY = 'fuzzy'
+
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_MAX_LIMIT = 50
+
+
+@contextmanager
+def similarity_threshold(value):
+    """
+    Set the threshold of the trigram `%` operator (lookup `trigram_similar`)
+    which, unlike filtering by `similarity`, can use the GIN trigram indexes,
+    for the queries of the block: they run on a transaction (SET LOCAL) so
+    they use the same server connection (e.g. pgbouncer transaction pooling)
+    and the session isn't modified.
+
+    Skipped if CATARAGONARIO_SET_SIMILARITY_THRESHOLD is False, i.e. when the
+    threshold is set on the database or role (saving the round trips), e.g.
+        ALTER ROLE <user> SET pg_trgm.similarity_threshold = 0.2;
+    """
+    if connection.vendor != 'postgresql' or not getattr(settings, 'CATARAGONARIO_SET_SIMILARITY_THRESHOLD', True):
+        yield
+        return
+
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)", [str(value)])
+        yield
+
+
+# TODO add method to WordManager
+def search_near_dialectal(self, query, lex=None, mode=MODE_STANDAR):
+    # https://docs.djangoproject.com/en/2.1/ref/contrib/postgres/search/#trigram-similarity
+    # evaluate it inside `similarity_threshold(NEAR_MIN_SIMILARITY)`
+    from django.contrib.postgres.search import TrigramSimilarity   # requires psycopg2
+
+    qs = self._filter_by_lexicon(lex)
+
+    if mode in [MODE_REVERSE, MODE_DIALECTAL]:
+        if mode == MODE_REVERSE:
+            qs = Entry.objects.filter(variation__isnull=True)
+        elif mode == MODE_DIALECTAL:
+            qs = Entry.objects.filter(variation__isnull=False)
+
+        qs = qs.filter(translation__trigram_similar=query).select_related('word').annotate(
+            similarity=TrigramSimilarity('translation', query)).distinct('translation', 'similarity')
+
+    else:
+        qs = qs.filter(term__trigram_similar=query).annotate(
+            similarity=TrigramSimilarity('term', query),
+        )
+
+    return qs.order_by('-similarity')
+
+
+def search_ranked(self, query, lex=None):
+    """
+    Exact, whole word and fuzzy matches of query on a single query ranked by
+    match tier and then by similarity (computed only once per word).
+    Evaluate it inside `similarity_threshold(NEAR_MIN_SIMILARITY)`.
+    """
+    from django.contrib.postgres.search import TrigramSimilarity   # requires psycopg2
+
+    key = fold(query)
+    exact = Q(search_key__term=key)
+    word = Q(search_key__term__startswith=key + ' ')
+
+    return self._filter_by_lexicon(lex).filter(exact | word | Q(term__trigram_similar=query)).annotate(
+        similarity=TrigramSimilarity('term', query),
+        tier=Case(When(exact, then=Value(0)), When(word, then=Value(1)), default=Value(2),
+                  output_field=IntegerField()),
+        match=Case(When(exact, then=Value(MATCH_EXACT)), When(word, then=Value(MATCH_WORD)),
+                   default=Value(MATCH_FUZZY), output_field=CharField()),
+    ).order_by('tier', '-similarity', 'term')
+
+
+def get_match(key, term_key):
+    """Return the match tier of a term (see `search_ranked`) given the search keys of query and term."""
+    if term_key == key:
+        return MATCH_EXACT
+    if term_key.startswith(key + ' '):
+        return MATCH_WORD
+    return MATCH_FUZZY
+
+
+def trigrams(value):
+    """
+    Return the set of trigrams of value like pg_trgm does: every word
+    (sequence of alphanumeric characters) is lowercased and padded with
+    two spaces at the beginning and one at the end.
+    """
+    words = ''.join(char if char.isalnum() else ' ' for char in value.lower()).split()
+    result = set()
+    for word in words:
+        word = '  {} '.format(word)
+        result.update(word[i:i + 3] for i in range(len(word) - 2))
+    return frozenset(result)
+
+
+def similarity(a, b):
+    """Same as pg_trgm `similarity` function."""
+    a, b = trigrams(a), trigrams(b)
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+class TrigramIndex:
+    """Inverted index from trigrams to the documents (key, text) which contain them."""
+
+    def __init__(self, documents):
+        self.keys = []
+        self.texts = []
+        self.sizes = []
+        self.postings = defaultdict(list)
+        for key, text in documents:
+            position = len(self.keys)
+            document_trigrams = trigrams(text)
+            self.keys.append(key)
+            self.texts.append(text)
+            self.sizes.append(len(document_trigrams))
+            for trigram in document_trigrams:
+                self.postings[trigram].append(position)
+        self.postings = dict(self.postings)
+
+    def search(self, query, threshold):
+        """Return [(key, similarity), ...] of documents more similar than threshold, most similar first."""
+        query_trigrams = trigrams(query)
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(self.postings.get(trigram, ()))
+
+        results = []
+        for position, count in shared.items():
+            score = count / (len(query_trigrams) + self.sizes[position] - count)
+            if score > threshold:
+                results.append((score, position))
+
+        results.sort(key=lambda result: (-result[0], self.texts[result[1]]))
+        return [(self.keys[position], score) for score, position in results]
+
+
+class LexiconIndex:
+    """
+    Trigram indexes of terms (by lexicon) and of the distinct translations
+    of normative and dialectal entries.
+    """
+
+    def __init__(self):
+        self.words = {
+            lexicon_code(lexicon): TrigramIndex(Word.objects.filter(lexicon=lexicon).values_list('id', 'term'))
+            for lexicon in Lexicon.objects.all()
+        }
+        self.entries = {
+            MODE_REVERSE: TrigramIndex(distinct_translations(Entry.objects.filter(variation__isnull=True))),
+            MODE_DIALECTAL: TrigramIndex(distinct_translations(Entry.objects.filter(variation__isnull=False))),
+        }
+
+    def search(self, query, lex, mode):
+        if mode in self.entries:
+            return self.entries[mode].search(query, NEAR_MIN_SIMILARITY)
+
+        results = []
+        for code, index in self.words.items():
+            if not lex or lex == code:
+                results += index.search(query, NEAR_MIN_SIMILARITY)
+        results.sort(key=lambda result: -result[1])
+        return results
+
+
+def lexicon_code(lexicon):
+    return '{}-{}'.format(lexicon.src_language, lexicon.dst_language)
+
+
+def distinct_translations(queryset):
+    # one entry by translation (like DISTINCT ON translation of PostgresSearchBackend)
+    return queryset.order_by().values('translation').annotate(entry_id=Min('id')).values_list(
+        'entry_id', 'translation')
+
+
+class PrefixIndex:
+    """Sorted array of texts by their search key (see `models.fold`) to look up them by prefix."""
+
+    def __init__(self, texts):
+        items = sorted({(fold(text), text) for text in texts})
+        self.keys = [key for key, _ in items]
+        self.texts = [text for _, text in items]
+
+    def complete(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        """Return the first `limit` texts (sorted) starting with prefix."""
+        prefix = fold(prefix)
+        if not prefix:
+            return []
+
+        results = []
+        position = bisect_left(self.keys, prefix)
+        while position < len(self.keys) and len(results) < limit and self.keys[position].startswith(prefix):
+            results.append(self.texts[position])
+            position += 1
+        return results
+
+
+class AutocompleteIndex:
+    """Prefix indexes of terms (by lexicon) and of normative and dialectal translations."""
+
+    def __init__(self):
+        self.words = {
+            lexicon_code(lexicon): PrefixIndex(Word.objects.filter(lexicon=lexicon).values_list('term', flat=True))
+            for lexicon in Lexicon.objects.all()
+        }
+        entries = Entry.objects.order_by().values_list('translation', flat=True).distinct()
+        self.entries = {
+            MODE_REVERSE: PrefixIndex(entries.filter(variation__isnull=True)),
+            MODE_DIALECTAL: PrefixIndex(entries.filter(variation__isnull=False)),
+        }
+
+    def complete(self, prefix, lex, mode, limit=AUTOCOMPLETE_LIMIT):
+        if mode in self.entries:
+            return self.entries[mode].complete(prefix, limit)
+
+        results = set()
+        for code, index in self.words.items():
+            if not lex or lex == code:
+                results.update(index.complete(prefix, limit))
+        return sorted(results, key=lambda text: (fold(text), text))[:limit]
+
+
+def get_autocomplete_index():
+    return build_autocomplete_index(get_lexicon_version())
+
+
+@lru_cache(maxsize=1)
+def build_autocomplete_index(version):
+    # version argument (database revision) discards the index once lexicon has been modified by any process
+    return AutocompleteIndex()
+
+
+class RankedResults:
+    """
+    Sequence of the ranked results of a search which only retrieves from
+    the database the objects of the requested slice (e.g. a page).
+    Results are (pk, value, ...) being values set as `fields` attributes.
+    """
+
+    def __init__(self, queryset, results, fields=('similarity',)):
+        self.queryset = queryset
+        self.results = results
+        self.fields = fields
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self[:])
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+
+        results = self.results[index]
+        objects = self.queryset.in_bulk([pk for pk, *_ in results])
+        page = []
+        for pk, *values in results:
+            obj = objects[pk]
+            for field, value in zip(self.fields, values):
+                setattr(obj, field, value)
+            page.append(obj)
+        return page
+
+
+class PostgresSearchBackend:
+    def evaluation(self):
+        """Context where the results of near & ranked have to be evaluated."""
+        return similarity_threshold(NEAR_MIN_SIMILARITY)
+
+    def near(self, query, lex, mode):
+        return search_near_dialectal(Word.objects, query, lex, mode)
+
+    def ranked(self, query, lex):
+        if not query:
+            return Word.objects.none()
+        return search_ranked(Word.objects, query, lex).select_related('lexicon')
+
+    def rebuild(self):
+        pass
+
+
+class MemorySearchBackend:
+    """
+    Search on an in-memory trigram index built on first use (and again when
+    the lexicon revision changes) or loaded from the snapshot file (setting
+    CATARAGONARIO_SEARCH_SNAPSHOT) when it changes.
+    """
+
+    def __init__(self):
+        self.index = None
+        self.version = None
+        self.snapshot = getattr(settings, 'CATARAGONARIO_SEARCH_SNAPSHOT', None)
+        self.snapshot_mtime = None
+
+    def evaluation(self):
+        return nullcontext()
+
+    def near(self, query, lex, mode):
+        if not query:
+            return []
+
+        results = self.get_index().search(query, lex, mode)
+        if mode in [MODE_REVERSE, MODE_DIALECTAL]:
+            return RankedResults(Entry.objects.select_related('word'), results)
+        return RankedResults(Word.objects.all(), results)
+
+    def ranked(self, query, lex):
+        if not query:
+            return []
+
+        # exact & whole word matches are looked up on the database (search keys)
+        key = fold(query)
+        matches = Word.objects._filter_by_lexicon(lex).filter(
+            Q(search_key__term=key) | Q(search_key__term__startswith=key + ' ')
+        ).values_list('id', 'term', 'search_key__term')
+        results = [(pk, similarity(query, term), get_match(key, term_key), term) for pk, term, term_key in matches]
+        results.sort(key=lambda result: (result[2] != MATCH_EXACT, -result[1], result[3]))
+
+        found = {pk for pk, *_ in results}
+        results = [(pk, score, match) for pk, score, match, _ in results]
+        results += [
+            (pk, score, MATCH_FUZZY) for pk, score in self.get_index().search(query, lex, MODE_STANDAR)
+            if pk not in found
+        ]
+        return RankedResults(Word.objects.select_related('lexicon'), results, fields=('similarity', 'match'))
+
+    def get_index(self):
+        if self.snapshot and os.path.exists(self.snapshot):
+            mtime = os.stat(self.snapshot).st_mtime
+            if mtime != self.snapshot_mtime:
+                with open(self.snapshot, 'rb') as f:
+                    self.index = pickle.load(f)
+                self.snapshot_mtime = mtime
+            return self.index
+
+        version = get_lexicon_version()
+        if self.index is None or self.version != version:
+            self.index = LexiconIndex()
+            self.version = version
+        return self.index
+
+    def rebuild(self):
+        """Discard the index (e.g. after an import) and update the snapshot (if any)."""
+        self.index = None
+        if not self.snapshot:
+            return
+
+        index = LexiconIndex()
+        fd, filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.snapshot)))
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(index, f)
+        os.replace(filename, self.snapshot)
+
+
+_backends = {}
+
+
+def get_search_backend():
+    """
+    Return the backend of setting CATARAGONARIO_SEARCH_BACKEND (by default
+    PostgreSQL one if the database supports it or the in-memory one).
+    """
+    path = getattr(settings, 'CATARAGONARIO_SEARCH_BACKEND', None)
+    if path is None:
+        path = 'cataragonario.search.{}'.format(
+            'PostgresSearchBackend' if connection.vendor == 'postgresql' else 'MemorySearchBackend')
+
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+def rebuild_search_index():
+    """
+    Rebuild the indexes of this process (and the snapshot). Other processes
+    rebuild theirs once they see the new lexicon revision.
+    """
+    build_autocomplete_index.cache_clear()
+    get_search_backend().rebuild()
@@ -1,10 +1,23 @@
-from linguatec_lexicon.models import Entry
+from django.conf import settings
+from django.db.models import Prefetch, Q, prefetch_related_objects
+from django.utils.functional import cached_property
+from linguatec_lexicon.models import DiatopicVariation, Entry
 from linguatec_lexicon.serializers import DiatopicVariationSerializer
 from linguatec_lexicon.serializers import \
     EntrySerializer as LinguatecEntrySerializer
 from linguatec_lexicon.serializers import \
     WordSerializer as LinguatecWordSerializer
+from linguatec_lexicon.serializers import WordNearSerializer
 from rest_framework import serializers
+from rest_framework.fields import SkipField
+from rest_framework.relations import PKOnlyObject
+
+from .search import MODE_STANDAR, SEARCH_MODES
+
+BATCH_SEARCH_MAX_QUERIES = 200
+
+# primary key used to reverse the URL templates of lean serializers
+URL_PLACEHOLDER = '9876543210'
 
 
 class EntryNearSerializer(serializers.ModelSerializer):
@@ -18,6 +31,12 @@ class EntryNearSerializer(serializers.ModelSerializer):
         fields = ('url', 'id', 'term', '_word')
 
 
+class BatchSearchSerializer(serializers.Serializer):
+    """Input of words batch-search: the queries (terms) and the search mode."""
+    q = serializers.ListField(child=serializers.CharField(trim_whitespace=True), max_length=BATCH_SEARCH_MAX_QUERIES)
+    mode = serializers.ChoiceField(choices=SEARCH_MODES, default=MODE_STANDAR)
+
+
 class EntrySerializer(LinguatecEntrySerializer):
     variation = serializers.SerializerMethodField()
 
@@ -30,50 +49,234 @@ class EntrySerializer(LinguatecEntrySerializer):
         instead of many "duplicated" entries with a single one
             normative language, then variation is None --> None
             if variation --> [variation1, variation2, variation3]
+        Variations are already serialized (see `prefetch_entries`).
         """
-        if not obj.variations:
-            return None
-
-        data = []
-        for v in obj.variations:
-            if v is None:
-                continue
-            srlz = DiatopicVariationSerializer(instance=v)
-            data.append(srlz.data)
-
-        return data
+        return self.context['entry_variations'].get(obj.id)
 
 
 class WordSerializer(LinguatecWordSerializer):
     entries = serializers.SerializerMethodField()
+    gramcats = serializers.SerializerMethodField()
 
     class Meta(LinguatecWordSerializer.Meta):
         pass
 
+    def get_entries_context(self, obj):
+        if 'entry_variations' in self.context:
+            return self.context
+        # serializer used outside WordViewSet: load the entries of this word
+        return prefetch_entries([obj])
+
+    def get_gramcats(self, obj):
+        return sorted(self.get_entries_context(obj)['word_gramcats'].get(obj.id, []))
+
     def get_entries(self, obj):
-        final_entries = []
-        grouped_entries = {}
-        for e in obj.entries.all():
-            # we don't want to group variation__isnull
-            if e.variation is None:
-                e.variations = []
-                final_entries.append(e)
-
-            elif e.translation in grouped_entries:
-                match_entry = grouped_entries[e.translation]
-                match_entry.variations.append(e.variation)
-
-            else:
-                # initialized multiple variations of current entry
-                # and store as base entry of grouped variations
-                e.variations = [e.variation]
-                grouped_entries[e.translation] = e
-
-        final_entries += list(grouped_entries.values())
-
-        data = []
-        for e in final_entries:
-            srlz = EntrySerializer(instance=e)
-            data.append(srlz.data)
-
-        return data
+        entry_variations = self.get_entries_context(obj)['entry_variations']
+        entries = get_word_entries(obj, entry_variations)
+        serializer = EntrySerializer(entries, many=True, context={'entry_variations': entry_variations})
+        return serializer.data
+
+
+class RankedWordSerializer(WordSerializer):
+    """Word of ranked search tagged with its match tier and similarity score."""
+    match = serializers.CharField(read_only=True)
+    score = serializers.FloatField(source='similarity', read_only=True)
+
+    class Meta(WordSerializer.Meta):
+        fields = tuple(WordSerializer.Meta.fields) + ('match', 'score')
+
+
+def get_word_entries(word, entry_variations):
+    """Return normative entries first and then the grouped dialectal ones."""
+    normative, dialectal = [], []
+    for e in word.entries.all():
+        if e.variation_id is None:
+            normative.append(e)
+        elif e.id in entry_variations:
+            dialectal.append(e)
+    return normative + dialectal
+
+
+def group_dialectal_entries(words):
+    """
+    Group the dialectal entries of the words by translation (fetched as
+    compact rows instead of model instances so it works on any database).
+    Return {entry_id: [variation_id, ...]} where entry_id is the first entry
+    of every group (the one serialized with all the variations).
+    """
+    groups = {}
+    rows = Entry.objects.filter(word__in=words, variation__isnull=False).order_by('id').values_list(
+        'id', 'word_id', 'translation', 'variation_id')
+    for entry_id, word_id, translation, variation_id in rows:
+        groups.setdefault((word_id, translation), (entry_id, []))[1].append(variation_id)
+    return dict(groups.values())
+
+
+def prefetch_entries(words):
+    """
+    Prefetch the entries required by WordSerializer with a constant number
+    of queries: normative ones and the first entry of every dialectal group.
+    Return the serializer context: serialized variations of every dialectal
+    group (`entry_variations`) and gramcats of every word (`word_gramcats`).
+    """
+    groups = group_dialectal_entries(words)
+    entries = Entry.objects.filter(
+        Q(variation__isnull=True) | Q(id__in=groups.keys())).prefetch_related('gramcats', 'examples')
+    prefetch_related_objects(words, Prefetch('entries', queryset=entries))
+
+    # serialize every distinct variation only once
+    variation_ids = {pk for ids in groups.values() for pk in ids}
+    variations = list(DiatopicVariation.objects.filter(id__in=variation_ids).select_related('region'))
+    data = DiatopicVariationSerializer(variations, many=True).data
+    serialized = {v.id: d for v, d in zip(variations, data)}
+
+    word_gramcats = {}
+    for word_id, abbreviation in Entry.objects.filter(word__in=words, gramcats__isnull=False).order_by().values_list(
+            'word_id', 'gramcats__abbreviation').distinct():
+        word_gramcats.setdefault(word_id, set()).add(abbreviation)
+
+    return {
+        'entry_variations': {entry_id: [serialized[pk] for pk in ids] for entry_id, ids in groups.items()},
+        'word_gramcats': word_gramcats,
+    }
+
+
+class LeanSerializerMixin:
+    """
+    Build the same representation than the serializer but faster: fields
+    with a `lean_<field name>(instance)` method skip DRF field machinery
+    (e.g. hyperlinks are formatted from a template reversed only once).
+    """
+
+    @cached_property
+    def lean_fields(self):
+        return [(field, getattr(self, 'lean_' + field.field_name, None)) for field in self._readable_fields]
+
+    def to_representation(self, instance):
+        ret = {}
+        for field, lean in self.lean_fields:
+            if lean is not None:
+                ret[field.field_name] = lean(instance)
+                continue
+
+            # same as Serializer.to_representation
+            try:
+                attribute = field.get_attribute(instance)
+            except SkipField:
+                continue
+            check_for_none = attribute.pk if isinstance(attribute, PKOnlyObject) else attribute
+            ret[field.field_name] = None if check_for_none is None else field.to_representation(attribute)
+        return ret
+
+    @cached_property
+    def url_templates(self):
+        return {}
+
+    def hyperlink(self, field_name, pk):
+        """Return the URL of the hyperlinked field `field_name` to the object with primary key `pk`."""
+        if field_name not in self.url_templates:
+            field = self.fields[field_name]
+            format = self.context.get('format')
+            if format and field.format and field.format != format:
+                format = field.format
+            url = field.get_url(PKOnlyObject(URL_PLACEHOLDER), field.view_name, self.context['request'], format)
+            self.url_templates[field_name] = url.rpartition(URL_PLACEHOLDER)[::2]
+
+        prefix, suffix = self.url_templates[field_name]
+        return '{}{}{}'.format(prefix, pk, suffix)
+
+
+class LeanEntrySerializer(LeanSerializerMixin, EntrySerializer):
+    @cached_property
+    def serialized_gramcats(self):
+        return {}
+
+    def lean_id(self, entry):
+        return entry.id
+
+    def lean_translation(self, entry):
+        return entry.translation
+
+    def lean_variation(self, entry):
+        return self.context['entry_variations'].get(entry.id)
+
+    def lean_gramcats(self, entry):
+        # serialize every distinct gramcat only once
+        gramcats = []
+        for gramcat in entry.gramcats.all():
+            if gramcat.id not in self.serialized_gramcats:
+                self.serialized_gramcats[gramcat.id] = self.fields['gramcats'].child.to_representation(gramcat)
+            gramcats.append(self.serialized_gramcats[gramcat.id])
+        return gramcats
+
+
+class LeanWordSerializer(LeanSerializerMixin, WordSerializer):
+    """WordSerializer of the words prefetched by WordViewSet (see `prefetch_entries`)."""
+
+    @cached_property
+    def entry_serializer(self):
+        return LeanEntrySerializer(context=self.context)
+
+    def lean_id(self, word):
+        return word.id
+
+    def lean_url(self, word):
+        return self.hyperlink('url', word.id)
+
+    def lean_term(self, word):
+        return word.term
+
+    def lean_gramcats(self, word):
+        return sorted(self.context['word_gramcats'].get(word.id, []))
+
+    def lean_entries(self, word):
+        entries = get_word_entries(word, self.context['entry_variations'])
+        return [self.entry_serializer.to_representation(entry) for entry in entries]
+
+
+class LeanRankedWordSerializer(LeanWordSerializer, RankedWordSerializer):
+    def lean_match(self, word):
+        return word.match
+
+    def lean_score(self, word):
+        return word.similarity
+
+
+class LeanWordNearSerializer(LeanSerializerMixin, WordNearSerializer):
+    def lean_id(self, word):
+        return word.id
+
+    def lean_url(self, word):
+        return self.hyperlink('url', word.id)
+
+    def lean_term(self, word):
+        return word.term
+
+
+class LeanEntryNearSerializer(LeanSerializerMixin, EntryNearSerializer):
+    def lean_id(self, entry):
+        return entry.word_id
+
+    def lean_url(self, entry):
+        return self.hyperlink('url', entry.word_id)
+
+    def lean_term(self, entry):
+        return entry.translation
+
+    def lean__word(self, entry):
+        return entry.word.term
+
+
+LEAN_SERIALIZERS = {
+    EntryNearSerializer: LeanEntryNearSerializer,
+    RankedWordSerializer: LeanRankedWordSerializer,
+    WordNearSerializer: LeanWordNearSerializer,
+    WordSerializer: LeanWordSerializer,
+}
+
+
+def get_lean_serializer_class(serializer_class):
+    """Return the lean version of serializer_class when enabled by setting CATARAGONARIO_LEAN_SERIALIZERS."""
+    if getattr(settings, 'CATARAGONARIO_LEAN_SERIALIZERS', False):
+        return LEAN_SERIALIZERS.get(serializer_class, serializer_class)
+    return serializer_class
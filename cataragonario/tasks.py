@@ -1,16 +1,149 @@
-from django.core.management import call_command
-from huey.contrib.djhuey import db_task
+import os
+import tempfile
+import traceback
 
+from django.conf import settings
+from django.core.management import call_command
 from django.core.management.base import CommandError
+from django.db import transaction
+from huey.contrib.djhuey import close_db, db_task, on_startup, signal
+from huey.signals import SIGNAL_ERROR
+
+from . import reports, uploads
+from .cache import bump_lexicon_version
+from .management.commands import importmultivariation
+from .models import ImportTask
+from .search import rebuild_search_index
+
+DEFAULT_IMPORT_CHUNK_SIZE = 5000
+
 
 @db_task()
 def run_validator(xlsx_file, log_filename):
-    # call_command('importmultivariation', xlsx_file, dry_run=True, no_color=True, verbosity=3, stdout=out)
+    report_filename = reports.get_report_filename(log_filename)
+    progress_filename = reports.get_progress_filename(log_filename)
     with open(log_filename, 'w') as f:
         try:
-            call_command('importmultivariation', xlsx_file, no_color=True, verbosity=3, stdout=f, stderr=f)
-        except CommandError as e:
-            exception_details = getattr(e, 'message', repr(e))
-            f.write(exception_details)
+            call_command(
+                'importmultivariation', xlsx_file, dry_run=True, report=report_filename,
+                progress=progress_filename, no_color=True, verbosity=3, stdout=f, stderr=f)
+        except Exception as e:
+            if isinstance(e, CommandError):
+                f.write(getattr(e, 'message', repr(e)))
+            else:
+                f.write(traceback.format_exc())
+
+            # failed before writing the report (e.g. invalid input file)
+            if reports.read_result(report_filename) is None:
+                report = reports.ReportWriter(report_filename, mode='a')
+                report.write(reports.FATAL, message=importmultivariation.get_error_message(e))
+                report.close()
+            reports.write_progress(progress_filename, dict(reports.read_progress(progress_filename) or {}, done=True))
+            return
 
         f.write("OK: no errors found!")
+
+
+def start_import(input_file, drop=False):
+    """Create the ImportTask of input_file and enqueue its first chunk."""
+    fd, log_file = tempfile.mkstemp(suffix='.log', dir=uploads.get_upload_dir())
+    os.close(fd)
+    task = ImportTask.objects.create(
+        input_file=input_file, log_file=log_file, drop=drop,
+        chunk_size=getattr(settings, 'CATARAGONARIO_IMPORT_CHUNK_SIZE', DEFAULT_IMPORT_CHUNK_SIZE),
+    )
+    transaction.on_commit(lambda: run_import(task.pk, task.worksheet, task.line))
+    return task
+
+
+@db_task(retries=3, retry_delay=10)
+def run_import(task_id, worksheet, line):
+    """
+    Import the chunk of ImportTask `task_id` starting on (worksheet, line)
+    and enqueue the next one: a pipeline of short tasks instead of a long
+    one. A chunk and the checkpoint (next chunk) are committed together so
+    duplicated messages are ignored and an interrupted import is resumed
+    from the last committed chunk (see `resume_imports`).
+    """
+    with transaction.atomic():
+        task = ImportTask.objects.select_for_update().get(pk=task_id)
+        if task.status != ImportTask.STATUS_RUNNING or (task.worksheet, task.line) != (worksheet, line):
+            return
+        import_chunk(task)
+
+    if task.status == ImportTask.STATUS_RUNNING:
+        run_import(task.pk, task.worksheet, task.line)
+    else:
+        rebuild_search_index()
+
+
+def import_chunk(task):
+    """
+    Import the next chunk of task and update its checkpoint. The lexicon
+    revision is bumped along with every chunk which commits changes, so
+    caches don't serve stale data even if a later chunk fails.
+    """
+    chunk = importmultivariation.Chunk(task.worksheet, task.line, task.line + task.chunk_size)
+    command = importmultivariation.Command()
+    drop = task.drop and chunk.worksheet == 0 and chunk.start == 2
+    with open(task.log_file, 'a') as f:
+        try:
+            # rows of a chunk with errors are rolled back (the import stops)
+            call_command(
+                command, task.input_file, chunk=chunk, atomic=importmultivariation.ATOMIC_IMPORT, drop=drop,
+                report=reports.get_report_filename(task.log_file), no_color=True, stdout=f, stderr=f)
+        except CommandError as e:
+            f.write(str(e))
+            task.status = ImportTask.STATUS_FAILED
+            task.save()
+            write_import_summary(task)
+            return
+
+    task.rows += command.rows
+    task.errors += command.rows_errors
+    task.es += command.es
+    task.cat += command.cat
+    task.franja += command.aralan
+    if command.rows_errors:
+        task.status = ImportTask.STATUS_FAILED
+    elif command.next_chunk is None:
+        task.status = ImportTask.STATUS_DONE
+    else:
+        task.worksheet, task.line = command.next_chunk.worksheet, command.next_chunk.start
+    task.save()
+
+    if not command.rows_errors and (command.rows or drop):
+        bump_lexicon_version()
+    if task.status != ImportTask.STATUS_RUNNING:
+        write_import_summary(task)
+
+
+def write_import_summary(task):
+    """Append the summary of the whole import to the report shared by its chunks."""
+    report = reports.ReportWriter(reports.get_report_filename(task.log_file), mode='a')
+    report.write(
+        reports.SUMMARY, es=task.es, cat=task.cat, franja=task.franja,
+        rows=task.rows, errors=task.errors, dry_run=False,
+    )
+    report.close()
+
+
+@signal(SIGNAL_ERROR)
+@close_db
+def fail_import(signal_name, task, exc=None):
+    """Mark as failed the import whose chunk has raised an exception and won't be retried."""
+    if not isinstance(task, run_import.task_class) or task.retries:
+        return
+
+    task_id = task.args[0]
+    if ImportTask.objects.filter(pk=task_id, status=ImportTask.STATUS_RUNNING).update(
+            status=ImportTask.STATUS_FAILED):
+        write_import_summary(ImportTask.objects.get(pk=task_id))
+        rebuild_search_index()
+
+
+@on_startup()
+def resume_imports():
+    """Enqueue again the imports interrupted by a worker restart."""
+    for task in ImportTask.objects.filter(status=ImportTask.STATUS_RUNNING):
+        run_import(task.pk, task.worksheet, task.line)
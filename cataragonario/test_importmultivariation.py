@@ -1,11 +1,21 @@
+from io import StringIO
+import json
+import os
+import tempfile
+import zipfile
 from pathlib import Path
 
 import linguatec_lexicon
-from django.core.management import call_command
+from django.core.management import CommandError, call_command
 from django.test import TestCase
 
 from linguatec_lexicon.models import Entry, Word
 
+from cataragonario import reports
+from cataragonario.management.commands.importmultivariation import Chunk, Command
+from cataragonario.models import EntrySearchKey, ImportTask, LexiconRevision, WordSearchKey
+from cataragonario.tasks import fail_import, import_chunk, run_import, run_validator
+
 BASE_DIR = Path(__file__).resolve().parent
 LINGUATEC_DIR = Path(linguatec_lexicon.__file__).parent
 
@@ -26,6 +36,12 @@ class ImportMultivariationTest(TestCase):
         self.assertEqual(2, Entry.objects.filter(variation__isnull=True).count())
         self.assertEqual(10, Entry.objects.filter(variation__isnull=False).count())
 
+    def test_search_keys(self):
+        call_command("importmultivariation", self.get_data_full_path("multiple-items.xlsx"))
+        self.assertEqual(Word.objects.count(), WordSearchKey.objects.count())
+        self.assertEqual(Entry.objects.count(), EntrySearchKey.objects.count())
+        self.assertTrue(EntrySearchKey.objects.filter(translation="cepillo gros").exists())
+
     def test_b(self):
         call_command("importmultivariation", self.get_data_full_path("entry-with-multiple-variations.xlsx"))
         self.assertEqual(1, Word.objects.count())
@@ -37,3 +53,245 @@ class ImportMultivariationTest(TestCase):
         self.assertEqual(2, Word.objects.count())
         self.assertEqual(2, Entry.objects.filter(variation__isnull=True).count())
         self.assertEqual(3, Entry.objects.filter(variation__isnull=False).count())
+
+    def test_import_csv(self):
+        call_command("importmultivariation", self.get_data_full_path("multiple-items.csv"))
+        self.assertEqual(2, Word.objects.count())
+        self.assertEqual(2, Entry.objects.filter(variation__isnull=True).count())
+        self.assertEqual(10, Entry.objects.filter(variation__isnull=False).count())
+
+    def test_import_tsv_gzip(self):
+        call_command("importmultivariation", self.get_data_full_path("multiple-items.tsv.gz"))
+        self.assertEqual(2, Word.objects.count())
+        self.assertEqual(12, Entry.objects.count())
+
+    def test_invalid_filetype(self):
+        self.assertRaises(
+            CommandError, call_command, "importmultivariation", self.get_data_full_path("multiple-items.xlsx.gz"))
+
+    def dump_entries(self):
+        return set(Entry.objects.values_list(
+            'word__term', 'translation', 'variation__name', 'gramcats__abbreviation'))
+
+    def test_bulk_write_matches_row_by_row(self):
+        path = self.get_data_full_path("multiple-items.xlsx")
+        out = StringIO()
+        call_command("importmultivariation", path, batch_size=0, stdout=out)
+        expected = self.dump_entries()
+
+        Word.objects.all().delete()
+        bulk_out = StringIO()
+        call_command("importmultivariation", path, batch_size=2, stdout=bulk_out)
+
+        self.assertEqual(expected, self.dump_entries())
+        self.assertEqual(out.getvalue(), bulk_out.getvalue())
+
+    def test_bulk_write_reimport(self):
+        path = self.get_data_full_path("multiple-items.xlsx")
+        call_command("importmultivariation", path)
+        out = StringIO()
+        call_command("importmultivariation", path, stdout=out)
+
+        self.assertIn("ES: 0   CAT: 0     FRANJA: 0", out.getvalue())
+        self.assertEqual(12, Entry.objects.count())
+
+    def test_atomic_import_rollback(self):
+        version = LexiconRevision.objects.get().version
+        path = self.get_data_full_path("worksheet-with-errors.xlsx")
+        call_command("importmultivariation", path, atomic="import", stderr=StringIO())
+        self.assertEqual(0, Word.objects.count())
+        self.assertEqual(version, LexiconRevision.objects.get().version)
+
+    def test_atomic_worksheet_rollback(self):
+        path = self.get_data_full_path("worksheet-with-errors.xlsx")
+        call_command("importmultivariation", path, atomic="worksheet", stderr=StringIO())
+        self.assertEqual(["ala"], list(Word.objects.values_list('term', flat=True)))
+
+    def test_dry_run(self):
+        path = self.get_data_full_path("multiple-items.xlsx")
+        out = StringIO()
+        with self.assertNumQueries(6):  # lexicon, reference data (3), existing words and entries (2)
+            call_command("importmultivariation", path, dry_run=True, stdout=out)
+
+        self.assertEqual(0, Word.objects.count())
+        self.assertIn("ES: 2   CAT: 2     FRANJA: 10", out.getvalue())
+        self.assertIn("DRY RUN", out.getvalue())
+
+    def test_dry_run_drop(self):
+        path = self.get_data_full_path("multiple-items.xlsx")
+        call_command("importmultivariation", path, stdout=StringIO())
+
+        # existing data would be dropped: report what the import would create
+        out = StringIO()
+        with self.assertNumQueries(4):  # lexicon, reference data (3)
+            call_command("importmultivariation", path, dry_run=True, drop=True, stdout=out)
+
+        self.assertEqual(2, Word.objects.count())
+        self.assertIn("ES: 2   CAT: 2     FRANJA: 10", out.getvalue())
+
+    def test_parallel_jobs(self):
+        path = self.get_data_full_path("worksheet-with-errors.xlsx")
+        out, err = StringIO(), StringIO()
+        call_command("importmultivariation", path, dry_run=True, stdout=out, stderr=err)
+
+        parallel_out, parallel_err = StringIO(), StringIO()
+        call_command("importmultivariation", path, dry_run=True, jobs=2, stdout=parallel_out, stderr=parallel_err)
+
+        self.assertEqual(out.getvalue(), parallel_out.getvalue())
+        self.assertEqual(err.getvalue(), parallel_err.getvalue())
+        self.assertIn("B.3", err.getvalue())
+
+    def test_incremental_import(self):
+        call_command("importmultivariation", self.get_data_full_path("entry-with-different-words.xlsx"))
+        expected = self.dump_entries()
+        Word.objects.all().delete()
+
+        call_command("importmultivariation", self.get_data_full_path("multiple-items.xlsx"))
+        out = StringIO()
+        call_command(
+            "importmultivariation", self.get_data_full_path("entry-with-different-words.xlsx"),
+            incremental=True, stdout=out)
+
+        self.assertEqual(expected, self.dump_entries())
+        self.assertEqual(2, Word.objects.count())
+        self.assertIn("DELETED: 12", out.getvalue())
+
+    def test_incremental_import_unchanged(self):
+        path = self.get_data_full_path("multiple-items.xlsx")
+        call_command("importmultivariation", path)
+        ids = set(Entry.objects.values_list('id', flat=True))
+
+        out = StringIO()
+        call_command("importmultivariation", path, incremental=True, stdout=out)
+
+        self.assertEqual(ids, set(Entry.objects.values_list('id', flat=True)))
+        self.assertIn("ES: 0   CAT: 0     FRANJA: 0", out.getvalue())
+        self.assertIn("UPDATED: 0     DELETED: 0", out.getvalue())
+
+    def test_report(self):
+        path = self.get_data_full_path("worksheet-with-errors.xlsx")
+        with tempfile.NamedTemporaryFile(suffix='.jsonl') as report:
+            call_command("importmultivariation", path, dry_run=True, report=report.name, stderr=StringIO())
+            records = [json.loads(line) for line in open(report.name)]
+
+        self.assertEqual(2, len(records))
+        error, summary = records
+        self.assertEqual(
+            {"type": "error", "worksheet": "B", "line": 3, "word": "bufa", "column": "C",
+             "message": "unkown region 'atlantis'"},
+            error)
+        self.assertEqual("summary", summary["type"])
+        self.assertEqual(2, summary["rows"])
+        self.assertEqual(1, summary["errors"])
+
+    def test_progress(self):
+        path = self.get_data_full_path("worksheet-with-errors.xlsx")
+        with tempfile.NamedTemporaryFile(suffix='.json') as progress:
+            call_command("importmultivariation", path, dry_run=True, progress=progress.name, stderr=StringIO())
+            status = json.load(open(progress.name))
+
+        self.assertEqual(True, status["done"])
+        self.assertEqual("B", status["worksheet"])
+        self.assertEqual((2, 1), (status["rows"], status["errors"]))
+        self.assertIn("rows_per_second", status)
+
+    def test_corrupted_file_reported(self):
+        upload_dir = tempfile.mkdtemp()
+        input_file = os.path.join(upload_dir, 'corrupted.xlsx')
+        with open(input_file, 'wb') as f:
+            f.write(b'not a zip file')
+        log_file = os.path.join(upload_dir, 'corrupted.log')
+
+        with self.assertRaises(zipfile.BadZipFile):
+            call_command(
+                "importmultivariation", input_file, dry_run=True, report=reports.get_report_filename(log_file),
+                progress=reports.get_progress_filename(log_file), stdout=StringIO())
+        run_validator.call_local(input_file, log_file)
+
+        records = list(reports.read_report(reports.get_report_filename(log_file)))
+        self.assertEqual([reports.FATAL], [record['type'] for record in records])
+        self.assertIn("BadZipFile", records[0]['message'])
+        self.assertTrue(reports.read_progress(reports.get_progress_filename(log_file))['done'])
+
+    def test_chunked_import(self):
+        path = self.get_data_full_path("multiple-items.xlsx")
+        call_command("importmultivariation", path)
+        expected = self.dump_entries()
+        Word.objects.all().delete()
+
+        chunks = []
+        chunk = Chunk(0, 2, 5)
+        while chunk is not None:
+            chunks.append(chunk)
+            command = Command()
+            call_command(command, path, chunk=chunk, stdout=StringIO())
+            chunk = command.next_chunk
+
+        self.assertEqual([Chunk(0, 2, 5), Chunk(0, 5, 8), Chunk(0, 8, 11)], chunks)
+        self.assertEqual(expected, self.dump_entries())
+
+    def test_chunk_invalid_options(self):
+        path = self.get_data_full_path("multiple-items.xlsx")
+        with self.assertRaises(CommandError):
+            call_command("importmultivariation", path, chunk=Chunk(0, 5, 8), drop=True)
+        with self.assertRaises(CommandError):
+            call_command("importmultivariation", path, chunk=Chunk(0, 2, 5), incremental=True)
+
+    def test_import_task(self):
+        log_file = tempfile.NamedTemporaryFile(suffix='.log')
+        task = ImportTask.objects.create(
+            input_file=self.get_data_full_path("multiple-items.xlsx"), log_file=log_file.name, chunk_size=3)
+
+        for _ in range(3):
+            import_chunk(task)
+        task.refresh_from_db()
+
+        self.assertEqual(ImportTask.STATUS_DONE, task.status)
+        self.assertEqual((7, 0), (task.rows, task.errors))
+        self.assertEqual(2, Word.objects.count())
+        self.assertEqual(12, Entry.objects.count())
+
+        # a single summary of the whole import (not one per chunk)
+        records = list(reports.read_report(reports.get_report_filename(log_file.name)))
+        self.assertEqual([reports.SUMMARY], [record['type'] for record in records])
+        self.assertEqual((7, 2, 2, 10), tuple(records[0][field] for field in ('rows', 'es', 'cat', 'franja')))
+
+    def test_import_task_bumps_revision_per_chunk(self):
+        log_file = tempfile.NamedTemporaryFile(suffix='.log')
+        task = ImportTask.objects.create(
+            input_file=self.get_data_full_path("multiple-items.xlsx"), log_file=log_file.name, chunk_size=3)
+
+        import_chunk(task)
+        version = LexiconRevision.objects.get().version
+        import_chunk(task)
+
+        # the rows of the first chunks are committed even if a later one fails
+        self.assertEqual(ImportTask.STATUS_RUNNING, task.status)
+        self.assertGreater(LexiconRevision.objects.get().version, version)
+
+    def test_import_task_errors(self):
+        log_file = tempfile.NamedTemporaryFile(suffix='.log')
+        task = ImportTask.objects.create(
+            input_file=self.get_data_full_path("worksheet-with-errors.xlsx"), log_file=log_file.name, chunk_size=10)
+
+        while task.status == ImportTask.STATUS_RUNNING:
+            import_chunk(task)
+
+        self.assertEqual(ImportTask.STATUS_FAILED, task.status)
+        self.assertEqual(1, task.errors)
+
+    def test_import_task_retries_exhausted(self):
+        log_file = tempfile.NamedTemporaryFile(suffix='.log')
+        task = ImportTask.objects.create(
+            input_file=self.get_data_full_path("multiple-items.xlsx"), log_file=log_file.name, chunk_size=10)
+        message = run_import.s(task.pk, task.worksheet, task.line)
+
+        # close_db (of the consumer) isn't called: it would close the connection of the test
+        fail_import.__wrapped__('error', message, Exception())
+        task.refresh_from_db()
+        self.assertEqual(ImportTask.STATUS_RUNNING, task.status)    # it will be retried
+
+        message.retries = 0
+        fail_import.__wrapped__('error', message, Exception())
+        task.refresh_from_db()
+        self.assertEqual(ImportTask.STATUS_FAILED, task.status)
@@ -0,0 +1,322 @@
+import os
+import tempfile
+import urllib.parse
+from pathlib import Path
+
+import linguatec_lexicon
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from linguatec_lexicon.models import Word
+
+from cataragonario import reports
+from cataragonario.cache import bump_lexicon_version, get_cache, get_lexicon_version
+from cataragonario.search import rebuild_search_index
+from cataragonario.views_importer import ImportMultiVariationValidatorView
+
+BASE_DIR = Path(__file__).resolve().parent
+LINGUATEC_DIR = Path(linguatec_lexicon.__file__).parent
+
+
+class LexiconTestCase(TestCase):
+    """Lexicon imported from the test data files."""
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        call_command("init_project")
+        call_command("importgramcat", LINGUATEC_DIR.parent.joinpath('tests/fixtures/gramcat-es-ar.csv'))
+        for filename in ["multiple-items.xlsx", "entry-with-different-words.xlsx"]:
+            call_command("importmultivariation", BASE_DIR.parent.joinpath("tests/data/", filename))
+        super().setUpTestData()
+
+    def setUp(self):
+        # cached responses & version aren't rolled back with the database
+        get_cache().clear()
+
+
+class WordViewSetTest(LexiconTestCase):
+    def count_queries(self, url, params):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, params)
+        self.assertEqual(200, response.status_code)
+        return len(context.captured_queries)
+
+    def test_list_constant_queries(self):
+        one_word = self.count_queries('/api/words/', {'limit': 1})
+        all_words = self.count_queries('/api/words/', {'limit': 50})
+        self.assertEqual(one_word, all_words)
+
+    def test_search_constant_queries(self):
+        params = {'q': 'escombra', 'l': 'es-ca', 'mode': 'reverse'}
+        one_word = self.count_queries('/api/words/search/', dict(params, limit=1))
+        all_words = self.count_queries('/api/words/search/', dict(params, limit=50))
+        self.assertEqual(one_word, all_words)
+
+    def test_search_cached_until_lexicon_changes(self):
+        params = {'q': 'garlopa', 'l': 'es-ca'}
+        uncached = self.count_queries('/api/words/search/', params)
+        self.assertEqual(0, self.count_queries('/api/words/search/', params))
+
+        bump_lexicon_version()
+        self.assertEqual(uncached, self.count_queries('/api/words/search/', params))
+
+    def batch_search(self, data):
+        return self.client.post('/api/words/batch-search/', data, content_type='application/json')
+
+    def test_batch_search(self):
+        response = self.batch_search({'q': ['Escoba', 'cepillo', 'xyz']})
+        results = response.json()['results']
+
+        self.assertEqual(['Escoba', 'cepillo', 'xyz'], list(results))
+        self.assertEqual(['escoba'], [w['term'] for w in results['Escoba']])
+        self.assertEqual([], results['xyz'])
+        search = self.client.get('/api/words/search/', {'q': 'cepillo', 'l': 'es-ca'})
+        self.assertEqual(search.json()['results'], results['cepillo'])
+
+        response = self.batch_search({'q': ['escombra', 'ribot'], 'mode': 'reverse'})
+        results = response.json()['results']
+        self.assertEqual(['balea', 'escoba'], [w['term'] for w in results['escombra']])
+        self.assertEqual(['cepillo'], [w['term'] for w in results['ribot']])
+
+    def test_batch_search_constant_queries(self):
+        with CaptureQueriesContext(connection) as one_query:
+            self.batch_search({'q': ['garlopa']})
+        with CaptureQueriesContext(connection) as many_queries:
+            self.batch_search({'q': ['garlopa', 'cepillo', 'balea', 'escoba']})
+        self.assertEqual(len(one_query.captured_queries), len(many_queries.captured_queries))
+
+    def test_batch_search_invalid(self):
+        self.assertEqual(400, self.batch_search({'q': ['escoba'], 'mode': 'foo'}).status_code)
+        self.assertEqual(400, self.batch_search({'mode': 'reverse'}).status_code)
+
+    def test_lean_serializers(self):
+        word_id = self.client.get('/api/words/search/', {'q': 'balea'}).json()['results'][0]['id']
+        requests = [
+            ('/api/words/', {'limit': 50}),
+            ('/api/words/{}/'.format(word_id), {}),
+            ('/api/words/search/', {'q': 'balea', 'l': 'es-ca'}),
+            ('/api/words/search/', {'q': 'escombra', 'mode': 'reverse'}),
+            ('/api/words/near/', {'q': 'garlopa', 'l': 'es-ca'}),
+            ('/api/words/near/', {'q': 'cepillo', 'mode': 'dialectal'}),
+        ]
+        for url, params in requests:
+            expected = self.client.get(url, params).content
+            bump_lexicon_version()  # don't reuse cached response
+            with self.settings(CATARAGONARIO_LEAN_SERIALIZERS=True):
+                self.assertEqual(expected, self.client.get(url, params).content)
+
+    def test_cursor_pagination(self):
+        params = {'pagination': 'cursor', 'limit': 1}
+        terms = []
+        url = '/api/words/'
+        with CaptureQueriesContext(connection) as context:
+            while url:
+                response = self.client.get(url, params).json()
+                self.assertNotIn('count', response)
+                terms += [w['term'] for w in response['results']]
+                url, params = response['next'], {}
+
+        self.assertEqual(sorted(terms), terms)
+        self.assertEqual(self.client.get('/api/words/', {'limit': 50}).json()['count'], len(terms))
+        self.assertFalse([q for q in context.captured_queries if 'COUNT(' in q['sql'].upper()])
+
+    def test_conditional_get(self):
+        word_id = self.client.get('/api/words/search/', {'q': 'balea'}).json()['results'][0]['id']
+        url = '/api/words/{}/'.format(word_id)
+
+        response = self.client.get(url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertEqual(304, self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+        self.assertEqual(304, self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code)
+        self.assertNotEqual(etag, self.client.get('/api/words/')['ETag'])
+
+        bump_lexicon_version()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_lexicon_version_shared_by_processes(self):
+        version = get_lexicon_version()
+        get_cache().clear()     # e.g. other process
+        self.assertEqual(version, get_lexicon_version())
+
+        new_version = bump_lexicon_version()
+        self.assertGreater(new_version, version)
+        get_cache().clear()
+        self.assertEqual(new_version, get_lexicon_version())
+
+    def test_lexicon_version_bumped_by_saves(self):
+        version = get_lexicon_version()
+        word = Word.objects.get(term='garlopa')
+
+        # e.g. admin: a single bump once the transaction is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            word.save()
+            word.entries.first().delete()
+        new_version = get_lexicon_version()
+        self.assertGreater(new_version, version)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            word.delete()
+        self.assertGreater(get_lexicon_version(), new_version)
+
+    def test_lookup(self):
+        response = self.client.get('/api/words/lookup/', {'q': 'garlopa', 'l': 'es-ca'})
+        results = response.json()['results']
+        self.assertEqual(('garlopa', 'exact'), (results[0]['term'], results[0]['match']))
+        self.assertEqual([], self.client.get('/api/words/lookup/', {'q': ''}).json()['results'])
+
+    def test_detail(self):
+        response = self.client.get('/api/words/search/', {'q': 'cepillo', 'l': 'es-ca'})
+        word = response.json()['results'][0]
+
+        response = self.client.get('/api/words/{}/'.format(word['id']))
+        self.assertEqual(word, response.json())
+        self.assertEqual(['s. m.'], word['gramcats'])
+
+    def test_entries_grouped_by_translation(self):
+        response = self.client.get('/api/words/search/', {'q': 'balea', 'l': 'es-ca'})
+        entries = response.json()['results'][0]['entries']
+
+        self.assertEqual(['escombra', 'escoba'], [e['translation'] for e in entries])
+        self.assertIsNone(entries[0]['variation'])
+        self.assertEqual(['Sopeira', 'Tolba'], [v['name'] for v in entries[1]['variation']])
+
+    def test_autocomplete(self):
+        response = self.client.get('/api/words/autocomplete/', {'q': 'Es', 'l': 'es-ca'})
+        self.assertEqual({'results': ['escoba']}, response.json())
+
+        response = self.client.get('/api/words/autocomplete/', {'q': 'cepillo', 'mode': 'dialectal'})
+        self.assertEqual(['cepilladora', 'cepillo', 'cepillo gros'], response.json()['results'])
+
+        response = self.client.get('/api/words/autocomplete/', {'q': 'g', 'mode': 'reverse', 'limit': 1})
+        self.assertEqual(['garlopa'], response.json()['results'])
+
+    def test_autocomplete_rebuilt_on_new_revision(self):
+        self.client.get('/api/words/autocomplete/', {'q': 'Es', 'l': 'es-ca'})
+
+        # lexicon modified by other process: the index is only discarded by the new revision
+        word = Word.objects.get(term='escoba')
+        Word.objects.create(lexicon=word.lexicon, term='escobilla')
+        bump_lexicon_version()
+
+        response = self.client.get('/api/words/autocomplete/', {'q': 'Es', 'l': 'es-ca'})
+        self.assertEqual({'results': ['escoba', 'escobilla']}, response.json())
+
+    def test_autocomplete_unknown_mode(self):
+        response = self.client.get('/api/words/autocomplete/', {'q': 'es', 'mode': 'foo'})
+        self.assertEqual(400, response.status_code)
+
+    def test_search_word_saved_outside_importer(self):
+        lexicon = Word.objects.get(term='escoba').lexicon
+        word = Word.objects.create(lexicon=lexicon, term='Escobón')
+        response = self.client.get('/api/words/search/', {'q': 'escobon', 'l': 'es-ca'})
+        self.assertEqual(['Escobón'], [w['term'] for w in response.json()['results']])
+
+        word.term = 'escobilla'
+        word.save()
+        response = self.client.get('/api/words/search/', {'q': 'Escobilla', 'l': 'es-ca'})
+        self.assertEqual(['escobilla'], [w['term'] for w in response.json()['results']])
+
+    def test_search_case_accent_insensitive(self):
+        response = self.client.get('/api/words/search/', {'q': 'ESCÓBA', 'l': 'es-ca'})
+        self.assertEqual(['escoba'], [w['term'] for w in response.json()['results']])
+
+        response = self.client.get('/api/words/search/', {'q': 'Escómbra', 'l': 'es-ca', 'mode': 'reverse'})
+        self.assertEqual({'escoba', 'balea'}, {w['term'] for w in response.json()['results']})
+
+
+@override_settings(CATARAGONARIO_SEARCH_BACKEND='cataragonario.search.MemorySearchBackend')
+class MemorySearchBackendTest(LexiconTestCase):
+    def setUp(self):
+        super().setUp()
+        # the index is shared by tests: discard the one built with the data of other test cases
+        rebuild_search_index()
+
+    def test_near(self):
+        response = self.client.get('/api/words/near/', {'q': 'escova', 'l': 'es-ca'})
+        results = response.json()['results']
+        self.assertEqual('escoba', results[0]['term'])
+
+    def test_near_reverse(self):
+        response = self.client.get('/api/words/near/', {'q': 'escombre', 'l': 'es-ca', 'mode': 'reverse'})
+        results = response.json()['results']
+        self.assertEqual('escombra', results[0]['term'])
+
+    def test_lookup(self):
+        response = self.client.get('/api/words/lookup/', {'q': 'Escoba', 'l': 'es-ca'})
+        word = response.json()['results'][0]
+        self.assertEqual(('escoba', 'exact', 1.0), (word['term'], word['match'], word['score']))
+        self.assertEqual(['escombra', 'escoba'], [e['translation'] for e in word['entries']])
+
+        response = self.client.get('/api/words/lookup/', {'q': 'escova', 'l': 'es-ca'})
+        self.assertEqual([('escoba', 'fuzzy')], [(w['term'], w['match']) for w in response.json()['results']])
+
+    def test_near_rebuilt_on_new_revision(self):
+        self.client.get('/api/words/near/', {'q': 'escova', 'l': 'es-ca'})
+
+        word = Word.objects.get(term='escoba')
+        Word.objects.create(lexicon=word.lexicon, term='escovilla')
+        bump_lexicon_version()
+
+        response = self.client.get('/api/words/near/', {'q': 'escovilla', 'l': 'es-ca'})
+        self.assertEqual('escovilla', response.json()['results'][0]['term'])
+
+    def test_near_without_results(self):
+        response = self.client.get('/api/words/near/', {'q': 'xyz', 'l': 'es-ca'})
+        self.assertEqual([], response.json()['results'])
+
+
+class ImportLogViewTest(TestCase):
+    def get_log(self, log_file):
+        return self.client.get(reverse('catalan-validator-log', kwargs={'name': urllib.parse.quote_plus(log_file)}))
+
+    def test_finished_without_result(self):
+        log_file = os.path.join(tempfile.mkdtemp(), 'validation.log')
+        open(log_file, 'w').close()
+        open(reports.get_report_filename(log_file), 'w').close()
+        self.assertContains(self.get_log(log_file), "Loading, please wait")
+
+        # e.g. worker crashed: the page must stop waiting for results
+        reports.write_progress(reports.get_progress_filename(log_file), {'done': True})
+        response = self.get_log(log_file)
+        self.assertContains(response, "Validation failed unexpectedly")
+        self.assertNotContains(response, "Loading, please wait")
+
+
+    def test_progress_of_import_task(self):
+        log_file = os.path.join(tempfile.mkdtemp(), 'import.log')
+        url = reverse('catalan-validator-progress', kwargs={'name': urllib.parse.quote_plus(log_file)})
+        self.assertEqual({'done': False}, self.client.get(url).json())
+
+        # chunked imports don't write progress, only the summary once finished
+        report = reports.ReportWriter(reports.get_report_filename(log_file))
+        report.write(reports.SUMMARY, es=0, cat=0, franja=0, rows=0, errors=0, dry_run=False)
+        report.close()
+        self.assertEqual({'done': True}, self.client.get(url).json())
+
+class ValidatorViewTest(TestCase):
+    def test_claim_log(self):
+        view = ImportMultiVariationValidatorView()
+        log_file = os.path.join(tempfile.mkdtemp(), 'validation.log')
+        report_file, progress_file = reports.get_report_filename(log_file), reports.get_progress_filename(log_file)
+
+        self.assertTrue(view.claim_log(log_file))
+        self.assertFalse(view.claim_log(log_file))  # being validated
+
+        # finished without results (e.g. worker crashed)
+        reports.write_progress(progress_file, {'done': True})
+        self.assertTrue(view.claim_log(log_file))
+        self.assertFalse(os.path.exists(progress_file))
+
+        report = reports.ReportWriter(report_file)
+        report.write(reports.SUMMARY, rows=1, errors=0)
+        report.close()
+        self.assertFalse(view.claim_log(log_file))  # validated
+
+        # stuck (e.g. task lost before starting)
+        os.remove(report_file)
+        os.utime(log_file, (0, 0))
+        self.assertTrue(view.claim_log(log_file))
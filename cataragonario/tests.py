@@ -1,11 +1,21 @@
+import hashlib
+import os
+import tempfile
 from pathlib import Path
 
 import linguatec_lexicon
 from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.management import call_command
-from django.test import TestCase
+from django.test import RequestFactory, TestCase, override_settings
+from linguatec_lexicon.models import DiatopicVariation, Region, Word
+from rest_framework.renderers import JSONRenderer
 
-from cataragonario.management.commands.importmultivariation import extract_regions
+from cataragonario.management.commands.importmultivariation import ReferenceData, RowEntry, extract_regions
+from cataragonario.models import fold
+from cataragonario.renderers import FastJSONRenderer
+from cataragonario.search import PrefixIndex, TrigramIndex, get_match, similarity, trigrams
+from cataragonario.uploads import UploadHandler, store_upload
 
 LINGUATEC_DIR = Path(linguatec_lexicon.__file__).parent
 
@@ -54,6 +64,16 @@ class RowEntryTest(TestCase):
         expected = [("ribagorza", []), ("litera", []), ("bajoara", [])]
         self.extract_and_assert(value, expected)
 
+    def test_trailing_comma(self):
+        value = "ribagorza (Sopeira),"
+        expected = [("ribagorza", ["sopeira"]), ]
+        self.extract_and_assert(value, expected)
+
+    def test_cached_value_not_modified(self):
+        value = "cinca (Saidí, Mequinensa)"
+        extract_regions(value)[0][1].append("fraga")
+        self.extract_and_assert(value, [("cinca", ["saidí", "mequinensa"])])
+
     def test_unbalanced_parenthesis(self):
         value = "ribagorza (Les Paüls), matarranya (Vall-de-roures("
         self.assertRaises(ValidationError, extract_regions, value)
@@ -130,3 +150,157 @@ class RowEntryRegionTest(TestCase):
         value = "riBagOrza"
         expected = ["Ribagorza"]
         self.extract_and_assert(value, expected)
+
+
+class ReferenceDataTest(TestCase):
+    @classmethod
+    def setUpTestData(cls) -> None:
+        super().setUpTestData()
+        call_command("init_project")
+        call_command("importgramcat", LINGUATEC_DIR.parent.joinpath('tests/fixtures/gramcat-es-ar.csv'))
+
+    def test_lookup_case_insensitive(self):
+        reference = ReferenceData()
+        self.assertEqual("Saidí", reference.get_variation("SAIDÍ").name)
+        self.assertEqual("Cinca", reference.get_region("cinca").name)
+        self.assertRaises(Region.DoesNotExist, reference.get_region, "unknown")
+
+    def test_gramcat_case_insensitive(self):
+        reference = ReferenceData()
+        self.assertEqual("s. m.", reference.get_gramcat("S. M.").abbreviation)
+
+    def test_duplicated_names(self):
+        region = Region.objects.get(name="Cinca")
+        Region.objects.create(name="CINCA")
+        DiatopicVariation.objects.create(name="saidí", abbreviation="saidí", region=region)
+
+        reference = ReferenceData()
+        self.assertRaises(Region.MultipleObjectsReturned, reference.get_region, "cinca")
+        self.assertRaises(DiatopicVariation.MultipleObjectsReturned, reference.get_variation, "Saidí")
+
+    def test_clean_row_without_queries(self):
+        reference = ReferenceData()
+        row = RowEntry(('bota', 's. f.', 'ribagorza (Sopeira), cinca', 'bota', 'bota'), 2, reference=reference)
+
+        with self.assertNumQueries(0):
+            row.clean()
+
+        self.assertEqual(["Sopeira", "Cinca"], [v.name for v in row.variations])
+
+    def test_version(self):
+        version = ReferenceData().get_version()
+        self.assertEqual(version, ReferenceData().get_version())
+
+        Region.objects.create(name="Atlantis")
+        self.assertNotEqual(version, ReferenceData().get_version())
+
+
+class FoldTest(TestCase):
+    def test_fold(self):
+        self.assertEqual("saidi", fold(" Saidí "))
+        self.assertEqual("pena-roja paul", fold("Pena-roja Paül"))
+
+
+class TrigramTest(TestCase):
+    def test_trigrams(self):
+        # https://www.postgresql.org/docs/current/pgtrgm.html
+        self.assertEqual({"  c", " ca", "cat", "at "}, trigrams("cat"))
+        self.assertEqual({"  f", " fo", "foo", "oo ", "  b", " ba", "bar", "ar "}, trigrams("foo|bar"))
+
+    def test_similarity(self):
+        self.assertEqual(1, similarity("Escoba", "escoba"))
+        self.assertEqual(0, similarity("escoba", "ala"))
+        self.assertAlmostEqual(0.363636, similarity("word", "two words"), places=6)
+
+    def test_match(self):
+        self.assertEqual('exact', get_match('cepillo', 'cepillo'))
+        self.assertEqual('word', get_match('cepillo', 'cepillo gros'))
+        self.assertEqual('fuzzy', get_match('cepillo', 'cepilladora'))
+
+    def test_index_search(self):
+        index = TrigramIndex([(1, "escoba"), (2, "escombra"), (3, "ala")])
+        results = index.search("escova", 0.2)
+
+        self.assertEqual([1, 2], [key for key, _ in results])
+        self.assertAlmostEqual(similarity("escova", "escoba"), results[0][1])
+
+
+class TrigramSimilarLookupTest(TestCase):
+    def test_lookup_registered(self):
+        sql, params = Word.objects.filter(term__trigram_similar='escoba').query.sql_with_params()
+        self.assertIn('%% %s', sql)
+        self.assertEqual(('escoba',), params)
+
+
+class PrefixIndexTest(TestCase):
+    def test_complete(self):
+        index = PrefixIndex(["cepillo", "garlopa", "cepillo gros", "cepilladora", "Cèrcol", "cepillo"])
+
+        self.assertEqual(["cepilladora", "cepillo", "cepillo gros"], index.complete("cepi"))
+        self.assertEqual(["cepilladora", "cepillo"], index.complete("CEPI", limit=2))
+        self.assertEqual(["Cèrcol"], index.complete("cer"))
+        self.assertEqual([], index.complete("x"))
+        self.assertEqual([], index.complete(" "))
+
+
+class FastJSONRendererTest(TestCase):
+    def test_same_output_as_json_renderer(self):
+        data = {'term': 'Saidí\u2028', 'entries': [{'id': 1, 'variation': None, 'similarity': 0.3}], 1: True}
+        self.assertEqual(JSONRenderer().render(data), FastJSONRenderer().render(data))
+        self.assertEqual(
+            JSONRenderer().render(data, 'application/json; indent=4'),
+            FastJSONRenderer().render(data, 'application/json; indent=4'),
+        )
+        self.assertEqual(b'', FastJSONRenderer().render(None))
+
+
+@override_settings(CATARAGONARIO_UPLOAD_DIR=tempfile.mkdtemp(), CATARAGONARIO_MAX_UPLOAD_SIZE=100)
+class StoreUploadTest(TestCase):
+    def test_store_upload(self):
+        content = b'x' * 100
+        filename, digest = store_upload(SimpleUploadedFile('a.xlsx', content))
+
+        self.assertEqual(hashlib.sha256(content).hexdigest(), digest)
+        with open(filename, 'rb') as f:
+            self.assertEqual(content, f.read())
+
+        # identical uploads are stored on the same file
+        self.assertEqual((filename, digest), store_upload(SimpleUploadedFile('b.xlsx', content)))
+
+    def test_store_upload_too_large(self):
+        upload_dir = tempfile.mkdtemp()
+        uploaded_file = SimpleUploadedFile('a.xlsx', b'x' * 101)
+        with self.settings(CATARAGONARIO_UPLOAD_DIR=upload_dir):
+            with self.assertRaises(ValidationError):
+                store_upload(uploaded_file)
+
+            # declared size is not trusted
+            uploaded_file.size = 1
+            with self.assertRaises(ValidationError):
+                store_upload(uploaded_file)
+
+        self.assertEqual([], os.listdir(upload_dir))
+
+    def post_file(self, content):
+        request = RequestFactory().post('/', {'input_file': SimpleUploadedFile('a.xlsx', content)})
+        handler = UploadHandler(request)
+        request.upload_handlers = [handler]
+        return request, handler
+
+    def test_upload_handler(self):
+        content = b'x' * 100
+        request, handler = self.post_file(content)
+        uploaded_file = request.FILES['input_file']
+        self.assertEqual(hashlib.sha256(content).hexdigest(), uploaded_file.sha256)
+
+        temporary_file = uploaded_file.temporary_file_path()
+        filename, digest = store_upload(uploaded_file)
+        self.assertEqual(uploaded_file.sha256, digest)
+        self.assertFalse(os.path.exists(temporary_file))     # moved instead of copied
+        with open(filename, 'rb') as f:
+            self.assertEqual(content, f.read())
+
+    def test_upload_handler_too_large(self):
+        request, handler = self.post_file(b'x' * 101)
+        self.assertNotIn('input_file', request.FILES)
+        self.assertTrue(handler.exceeded)
@@ -0,0 +1,115 @@
+"""
+Storage of the files uploaded to the validator: they are streamed to disk
+chunk by chunk (never loaded whole in memory) and named by the SHA-256 of
+their content so identical uploads are detected and stored only once.
+
+UploadHandler computes the digest while the request is received and stops
+receiving it once the file exceeds the maximum size.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files.uploadhandler import StopUpload, TemporaryFileUploadHandler
+from django.template.defaultfilters import filesizeformat
+
+DEFAULT_MAX_UPLOAD_SIZE = 50 * 1024 * 1024
+
+
+def get_upload_dir():
+    return getattr(settings, 'CATARAGONARIO_UPLOAD_DIR', os.path.join(tempfile.gettempdir(), 'cataragonario'))
+
+
+def get_max_upload_size():
+    return getattr(settings, 'CATARAGONARIO_MAX_UPLOAD_SIZE', DEFAULT_MAX_UPLOAD_SIZE)
+
+
+def get_too_large_error():
+    return ValidationError(
+        "File too large (maximum size is %(size)s).", code='max_size',
+        params={'size': filesizeformat(get_max_upload_size())})
+
+
+class UploadHandler(TemporaryFileUploadHandler):
+    """
+    Stream uploaded files to temporary files computing their SHA-256 (as
+    `sha256` attribute) and stop the upload once a file exceeds
+    CATARAGONARIO_MAX_UPLOAD_SIZE (then `exceeded` is True).
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.max_size = get_max_upload_size()
+        self.exceeded = False
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.digest = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > self.max_size:
+            self.exceeded = True
+            self.upload_interrupted()
+            # don't read the rest of the request
+            raise StopUpload(connection_reset=True)
+
+        self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        uploaded_file.sha256 = self.digest.hexdigest()
+        return uploaded_file
+
+
+def store_upload(uploaded_file, suffix='.xlsx'):
+    """
+    Write uploaded_file to the upload directory and return (filename, digest).
+    Raise ValidationError if it is bigger than CATARAGONARIO_MAX_UPLOAD_SIZE.
+    """
+    max_size = get_max_upload_size()
+    too_large = get_too_large_error()
+    if uploaded_file.size is not None and uploaded_file.size > max_size:
+        raise too_large
+
+    upload_dir = get_upload_dir()
+    os.makedirs(upload_dir, exist_ok=True)
+
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        # already on disk: move it (renamed if it's on the same filesystem) instead of copying it
+        digest = getattr(uploaded_file, 'sha256', None) or hash_file(uploaded_file.temporary_file_path())
+        filename = os.path.join(upload_dir, digest + suffix)
+        shutil.move(uploaded_file.temporary_file_path(), filename)
+        return filename, digest
+
+    digest = hashlib.sha256()
+    size = 0
+    tmp_fd, tmp_file = tempfile.mkstemp(suffix=suffix, dir=upload_dir)
+    try:
+        with os.fdopen(tmp_fd, 'wb') as f:
+            for chunk in uploaded_file.chunks():
+                # size declared by the client could be wrong
+                size += len(chunk)
+                if size > max_size:
+                    raise too_large
+                digest.update(chunk)
+                f.write(chunk)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+
+    # an identical upload is replaced by the same content
+    filename = os.path.join(upload_dir, digest.hexdigest() + suffix)
+    os.replace(tmp_file, filename)
+    return filename, digest.hexdigest()
+
+
+def hash_file(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -15,4 +15,8 @@ urlpatterns = [
     path('', include(router.urls)),
     path('validator/', views_importer.ImportMultiVariationValidatorView.as_view(), name='catalan-validator'),
     path('validator/logs/<name>/', views_importer.ImportLogView.as_view(), name='catalan-validator-log'),
+    path('validator/logs/<name>/progress/', views_importer.ImportProgressView.as_view(),
+         name='catalan-validator-progress'),
+    path('import/', views_importer.ImportMultiVariationView.as_view(), name='catalan-import'),
+    path('import/<int:pk>/', views_importer.ImportTaskView.as_view(), name='catalan-import-detail'),
 ]
@@ -1,71 +1,99 @@
-from django.contrib.postgres.search import TrigramSimilarity
-from linguatec_lexicon.models import Entry, Word
+from collections import defaultdict
+
+from django.db.models import Case, F, IntegerField, Q, Value, When
+from linguatec_lexicon.models import Word
 from linguatec_lexicon.serializers import WordNearSerializer
 from linguatec_lexicon.views import DefaultLimitOffsetPagination
 from rest_framework import viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
-from .serializers import EntryNearSerializer, WordSerializer
-
-MODE_DIALECTAL = 'dialectal'
-MODE_REVERSE = 'reverse'
-MODE_STANDAR = 'standar'
-
-SEARCH_MODES = (MODE_STANDAR, MODE_REVERSE, MODE_DIALECTAL)
-
-# TODO add method to WordManager
-def search_near_dialectal(self, query, lex=None, mode=MODE_STANDAR):
-    # https://docs.djangoproject.com/en/2.1/ref/contrib/postgres/search/#trigram-similarity
-    # https://www.postgresql.org/docs/current/pgtrgm.html
-    # 0 means totally different
-    # 1 means identical
-    MIN_SIMILARITY = 0.2
-
-    qs = self._filter_by_lexicon(lex)
-
-    if mode in [MODE_REVERSE, MODE_DIALECTAL]:
-        if mode == MODE_REVERSE:
-            qs = Entry.objects.filter(variation__isnull=True)
-        elif mode == MODE_DIALECTAL:
-            qs = Entry.objects.filter(variation__isnull=False)
-
-        qs = qs.annotate(similarity=TrigramSimilarity('translation', query)).filter(
-            similarity__gt=MIN_SIMILARITY).distinct('translation', 'similarity')
-
-    else:
-        qs = qs.annotate(
-            similarity=TrigramSimilarity('term', query),
-        ).filter(similarity__gt=MIN_SIMILARITY)
-
-    return qs.order_by('-similarity')
+from .cache import cache_response, conditional_response
+from .models import fold
+from .pagination import WordCursorPagination, use_cursor_pagination
+from .renderers import get_renderer_classes
+from .search import (AUTOCOMPLETE_LIMIT, AUTOCOMPLETE_MAX_LIMIT, MODE_DIALECTAL, MODE_REVERSE, MODE_STANDAR,
+                     SEARCH_MODES, get_autocomplete_index, get_search_backend)
+from .serializers import (BatchSearchSerializer, EntryNearSerializer, RankedWordSerializer, WordSerializer,
+                          get_lean_serializer_class, prefetch_entries)
 
 
 # TODO add method to WordManager
 # --> https://www.ianlewis.org/en/dynamically-adding-method-classes-or-class-instanc
 def search_dialectal(self, query, lex=None, mode=MODE_STANDAR):
-    MIN_SIMILARITY = 0.3
-    iregex = r"\y{0}\y"
-
+    """
+    Match query (case and accent insensitive) against the search keys (see
+    `models.fold`) so lookups are served by their indexes.
+    """
     # query = self._clean_search_query(query)
     # qs = self._filter_by_lexicon(lex)
     qs = self
+    if query is None:
+        return qs.none()
 
+    key = fold(query)
     if mode == MODE_REVERSE:
-        qs = qs.filter(entries__translation=query, entries__variation__isnull=True).distinct()
+        qs = qs.filter(entries__search_key__translation=key, entries__variation__isnull=True).distinct()
 
     elif mode == MODE_DIALECTAL:
-        qs = qs.filter(entries__translation=query, entries__variation__isnull=False).distinct()
+        qs = qs.filter(entries__search_key__translation=key, entries__variation__isnull=False).distinct()
 
     else:   # STANDAR MODE
+        # exact match or terms whose first word is the query (e.g. "cepillo" --> "cepillo gros")
         qs = qs.filter(
-            term__iregex=iregex.format(query)
-        ).annotate(similarity=TrigramSimilarity('term', query)
-                   ).filter(similarity__gt=MIN_SIMILARITY).order_by('-similarity')
+            Q(search_key__term=key) | Q(search_key__term__startswith=key + ' ')
+        ).annotate(
+            exact=Case(When(search_key__term=key, then=Value(0)), default=Value(1), output_field=IntegerField()),
+        ).order_by('exact', 'term')
 
     return qs
 
 
+def batch_search_dialectal(self, queries, mode=MODE_STANDAR):
+    """
+    Resolve many queries (see `search_dialectal`) with a single database query.
+    Return {query: [word, ...]} keeping the order of the search results.
+    """
+    keys = {query: fold(query) for query in queries}
+    wanted = set(keys.values()) - {''}
+    words = {}                      # a word matched by many queries is loaded once
+    matches = defaultdict(dict)     # key --> {word_id: rank}
+
+    if wanted and mode in [MODE_REVERSE, MODE_DIALECTAL]:
+        qs = self.filter(
+            entries__search_key__translation__in=wanted, entries__variation__isnull=(mode == MODE_REVERSE),
+        ).annotate(match=F('entries__search_key__translation'))
+        for word in qs.select_related('lexicon').order_by('term'):
+            words.setdefault(word.id, word)
+            matches[word.match][word.id] = 0
+
+    elif wanted:    # STANDAR MODE
+        condition = Q(search_key__term__in=wanted)
+        for key in wanted:
+            condition |= Q(search_key__term__startswith=key + ' ')
+        qs = self.filter(condition).annotate(match=F('search_key__term'))
+        for word in qs.select_related('lexicon').order_by('term'):
+            words[word.id] = word
+            for key in term_prefixes(word.match):
+                if key in wanted:
+                    # exact match first (like search_dialectal)
+                    matches[key][word.id] = 0 if key == word.match else 1
+
+    return {
+        query: [words[word_id] for word_id, _ in sorted(matches[key].items(), key=lambda match: match[1])]
+        for query, key in keys.items()
+    }
+
+
+def term_prefixes(key):
+    """Return the keys matched by key on standar mode (e.g. "a b c" --> "a b c", "a", "a b")."""
+    yield key
+    for position, char in enumerate(key):
+        if char == ' ':
+            yield key[:position]
+
+
 class WordViewSet(viewsets.ReadOnlyModelViewSet):
     """
     API endpoint that allows words to be viewed.
@@ -73,26 +101,97 @@ class WordViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = Word.objects.all().order_by('term')
     serializer_class = WordSerializer
     pagination_class = DefaultLimitOffsetPagination
+    renderer_classes = get_renderer_classes()
+
+    def get_queryset(self):
+        return super().get_queryset().select_related('lexicon')
+
+    @property
+    def paginator(self):
+        # list & search opt-in keyset pagination (see WordCursorPagination)
+        if (not hasattr(self, '_paginator') and self.action in ['list', 'search']
+                and use_cursor_pagination(self.request)):
+            self._paginator = WordCursorPagination()
+        return super().paginator
+
+    def get_serializer_class(self):
+        return get_lean_serializer_class(super().get_serializer_class())
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context.update(getattr(self, 'entries_context', {}))
+        return context
+
+    @conditional_response
+    def list(self, request, *args, **kwargs):
+        return self.get_words_response(self.filter_queryset(self.get_queryset()))
+
+    @conditional_response
+    def retrieve(self, request, *args, **kwargs):
+        instance = self.get_object()
+        self.entries_context = prefetch_entries([instance])
+        serializer = self.get_serializer(instance)
+        return Response(serializer.data)
 
     @action(detail=False)
+    @conditional_response
+    @cache_response
     def near(self, request):
         query = self.request.query_params.get('q', None)
         lex = self.request.query_params.get('l', '')
         lex = lex.strip()
         mode = self.request.query_params.get('mode', MODE_STANDAR)
 
-        queryset = search_near_dialectal(Word.objects, query, lex, mode)
+        backend = get_search_backend()
         self.serializer_class = self.get_near_serializer_class(mode)
 
-        page = self.paginate_queryset(queryset)
-        if page is not None:
-            serializer = self.get_serializer(page, many=True)
-            return self.get_paginated_response(serializer.data)
+        with backend.evaluation():
+            queryset = backend.near(query, lex, mode)
+            page = self.paginate_queryset(queryset)
+            if page is not None:
+                serializer = self.get_serializer(page, many=True)
+                return self.get_paginated_response(serializer.data)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data)
+            serializer = self.get_serializer(queryset, many=True)
+            return Response(serializer.data)
 
     @action(detail=False)
+    @conditional_response
+    @cache_response
+    def lookup(self, request):
+        """
+        Unified search (standar mode): exact matches, terms starting with query
+        (whole words) and then fuzzy ones; tagged with their match tier & score.
+        """
+        query = self.request.query_params.get('q', '').strip()
+        lex = self.request.query_params.get('l', '').strip()
+
+        self.serializer_class = RankedWordSerializer
+        backend = get_search_backend()
+        with backend.evaluation():
+            return self.get_words_response(backend.ranked(query, lex))
+
+    @action(detail=False)
+    @conditional_response
+    def autocomplete(self, request):
+        """Return the terms (or translations on reverse & dialectal modes) starting with query."""
+        query = self.request.query_params.get('q', '')
+        lex = self.request.query_params.get('l', '').strip()
+        mode = self.request.query_params.get('mode', MODE_STANDAR)
+        if mode not in SEARCH_MODES:
+            raise ValidationError({'mode': 'Unknown mode "{}".'.format(mode)})
+
+        try:
+            limit = min(int(self.request.query_params.get('limit', AUTOCOMPLETE_LIMIT)), AUTOCOMPLETE_MAX_LIMIT)
+        except ValueError:
+            limit = AUTOCOMPLETE_LIMIT
+
+        results = get_autocomplete_index().complete(query, lex, mode, max(limit, 0))
+        return Response({'results': results})
+
+    @action(detail=False)
+    @conditional_response
+    @cache_response
     def search(self, request):
         query = self.request.query_params.get('q', None)
         lex = self.request.query_params.get('l', '')
@@ -102,14 +201,34 @@ class WordViewSet(viewsets.ReadOnlyModelViewSet):
             query = query.strip()
         lex = lex.strip()
 
-        queryset = search_dialectal(Word.objects, query, lex, mode)
+        queryset = search_dialectal(Word.objects, query, lex, mode).select_related('lexicon')
+        return self.get_words_response(queryset)
+
+    @action(detail=False, methods=['post'], url_path='batch-search')
+    def batch_search(self, request):
+        """Search many queries (e.g. all the words of a text) at once."""
+        serializer = BatchSearchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
 
+        results = batch_search_dialectal(Word.objects, serializer.validated_data['q'],
+                                         serializer.validated_data['mode'])
+        words = {word.id: word for query_words in results.values() for word in query_words}
+        self.entries_context = prefetch_entries(list(words.values()))
+
+        return Response({
+            'results': {
+                query: self.get_serializer(query_words, many=True).data for query, query_words in results.items()
+            }
+        })
+
+    def get_words_response(self, queryset):
         page = self.paginate_queryset(queryset)
+        words = list(queryset) if page is None else page
+        self.entries_context = prefetch_entries(words)
+
+        serializer = self.get_serializer(words, many=True)
         if page is not None:
-            serializer = self.get_serializer(page, many=True)
             return self.get_paginated_response(serializer.data)
-
-        serializer = self.get_serializer(queryset, many=True)
         return Response(serializer.data)
 
     def get_near_serializer_class(self, mode):
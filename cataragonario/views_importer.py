@@ -1,38 +1,76 @@
+import hashlib
+import json
 import os
-import tempfile
+import time
 import urllib.parse
 
-from django.http import Http404
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage, Paginator
+from django.http import Http404, JsonResponse
 from django.shortcuts import redirect
-from django.views.generic.base import TemplateView
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+from django.views.generic import DetailView
+from django.views.generic.base import TemplateView, View
 from linguatec_lexicon.forms import ValidatorForm
 
-from . import tasks
+from . import get_version, reports, tasks, uploads
+from .cache import get_lexicon_version
+from .management.commands.importmultivariation import ReferenceData
+from .models import ImportTask
 
+# seconds without progress after which a validation without results is run again (e.g. worker crashed)
+VALIDATION_TIMEOUT = 120
 
-class ImportMultiVariationValidatorView(TemplateView):
+
+@method_decorator(csrf_exempt, name='dispatch')
+class UploadMixin:
+    """
+    Receive the uploaded file with `uploads.UploadHandler` (size limit and
+    digest computed while streaming it to disk). The handler is installed
+    before the CSRF check, which reads the request body.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        self.upload_handler = uploads.UploadHandler(request)
+        request.upload_handlers = [self.upload_handler]
+        return csrf_protect(super().dispatch)(request, *args, **kwargs)
+
+    def get_upload_form(self):
+        form = ValidatorForm(self.request.POST, self.request.FILES)
+        if self.upload_handler.exceeded:
+            # the file has been discarded: replace the "required" error
+            form.errors['input_file'] = form.error_class(uploads.get_too_large_error().messages)
+        return form
+
+
+class ImportMultiVariationValidatorView(UploadMixin, TemplateView):
     template_name = "linguatec_lexicon/datavalidator.html"
     title = "Catalan diatopic validator"
 
     def post(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
-        form = ValidatorForm(request.POST, request.FILES)
+        form = self.get_upload_form()
 
         if form.is_valid():
-            xlsx_file = form.cleaned_data['input_file']
-
-            # store uploaded file as a temporal file
-            tmp_fd, tmp_file = tempfile.mkstemp(suffix='.xlsx')
-            f = os.fdopen(tmp_fd, 'wb')  # open the tmp file for writing
-            f.write(xlsx_file.read())  # write the tmp file
-            f.close()
-
-            # validate uploaded file and handle errors (if any)
-            log_file = self.get_log_filename(tmp_file)
-            tasks.run_validator(tmp_file, log_file)
-
-            log_file = urllib.parse.quote_plus(log_file)
-            return redirect("catalan-validator-log", name=log_file)
+            try:
+                # store uploaded file streaming it to disk
+                input_file, digest = uploads.store_upload(form.cleaned_data['input_file'])
+            except ValidationError as e:
+                form.add_error('input_file', e)
+            else:
+                log_file = self.get_log_filename(digest)
+                if self.claim_log(log_file):
+                    try:
+                        # validate uploaded file and handle errors (if any)
+                        tasks.run_validator(input_file, log_file)
+                    except Exception:
+                        os.remove(log_file)     # release the claim
+                        raise
+
+                log_file = urllib.parse.quote_plus(log_file)
+                return redirect("catalan-validator-log", name=log_file)
 
         context['form'] = form
         return self.render_to_response(context)
@@ -45,27 +83,169 @@ class ImportMultiVariationValidatorView(TemplateView):
         })
         return context
 
-    def get_log_filename(self, filename):
-        _, tmp_file = tempfile.mkstemp(suffix='.log')
-        return tmp_file
+    def claim_log(self, log_file):
+        """
+        Claim the log so identical uploads are validated only once: return
+        False if it's already validated (or being validated) to reuse its
+        results, True if the validation has to run (again if it was stuck).
+        """
+        try:
+            open(log_file, 'x').close()
+            return True
+        except FileExistsError:
+            pass
+
+        if reports.read_result(reports.get_report_filename(log_file)) is not None:
+            return False
+
+        progress_file = reports.get_progress_filename(log_file)
+        progress = reports.read_progress(progress_file)
+        updated = max(os.path.getmtime(f) for f in (log_file, progress_file) if os.path.exists(f))
+        if not (progress and progress['done']) and time.time() - updated < VALIDATION_TIMEOUT:
+            return False
+
+        # finished without results or stuck: discard its output and claim it again
+        for filename in (reports.get_report_filename(log_file), progress_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+        os.utime(log_file)
+        return True
+
+    def get_log_filename(self, digest):
+        """
+        Return the log filename of the validation results of an uploaded file
+        (by its digest) on the current reference data (gramcats, regions and
+        variations), lexicon (duplicated rows are reported) and importer version.
+        """
+        key = json.dumps([digest, ReferenceData().get_version(), get_lexicon_version(), get_version()])
+        return os.path.join(uploads.get_upload_dir(), hashlib.sha256(key.encode('utf-8')).hexdigest() + '.log')
 
 
 class ImportLogView(TemplateView):
     template_name = "cataragonario/import-log-detail.html"
+    paginate_by = 100
+    filter_fields = ('worksheet', 'column', 'q')
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        log_file = urllib.parse.unquote_plus(kwargs['name'])
+        log_file = self.log_file = urllib.parse.unquote_plus(kwargs['name'])
+        context['title'] = "Import log"
+
+        report_file = reports.get_report_filename(log_file)
+        if os.path.exists(report_file):
+            context.update(self.retrieve_report(report_file))
+        else:
+            context['output'] = self.retrieve_log_content(log_file)
+        return context
+
+    def retrieve_report(self, filename):
+        """
+        Read the report line by line keeping only the errors of the
+        requested page (matching the filters) and the summary.
+        """
+        filters = {field: self.request.GET.get(field, '').strip() for field in self.filter_fields}
+        try:
+            number = int(self.request.GET.get('page', 1))
+        except ValueError:
+            raise Http404("Invalid page")
+
+        bottom = (number - 1) * self.paginate_by
+        top = bottom + self.paginate_by
+        context = {'filters': filters, 'summary': None, 'fatal': None}
+        errors, count = [], 0
+        for record in reports.read_report(filename):
+            if record['type'] != reports.ERROR:
+                context[record['type']] = record
+            elif self.match_filters(record, filters):
+                if bottom <= count < top:
+                    errors.append(record)
+                count += 1
+
+        try:
+            page = Paginator(range(count), self.paginate_by).page(number)
+        except InvalidPage:
+            raise Http404("Invalid page")
+        page.object_list = errors
+
         context.update({
-            'title': "Import log",
-            'output': self.retrieve_log_content(log_file),
+            'report': True,
+            'page_obj': page,
+            'output': context['summary'] or context['fatal'],
         })
+        if not context['output']:
+            # finished without result (e.g. worker crash): don't wait for it forever
+            progress = reports.read_progress(reports.get_progress_filename(self.log_file))
+            context['failed'] = bool(progress and progress['done'])
         return context
 
+    def match_filters(self, record, filters):
+        if filters['worksheet'] and filters['worksheet'] != str(record['worksheet']):
+            return False
+        if filters['column'] and filters['column'].upper() != record['column']:
+            return False
+        if filters['q']:
+            query = filters['q'].lower()
+            return query in str(record['word']).lower() or query in record['message'].lower()
+        return True
+
     def retrieve_log_content(self, filename):
         try:
             content = open(filename, mode='r').read()
         except FileNotFoundError:
             raise Http404("Log does not exist")
         return content
+
+
+class ImportProgressView(View):
+    """Progress of the validation as JSON (cheap to poll while it runs)."""
+
+    def get(self, request, *args, **kwargs):
+        log_file = urllib.parse.unquote_plus(kwargs['name'])
+        progress = reports.read_progress(reports.get_progress_filename(log_file))
+        if progress is None:
+            # background imports (see `tasks.import_chunk`) don't write progress but a final result
+            done = reports.read_result(reports.get_report_filename(log_file)) is not None
+            progress = {'done': done}
+        return JsonResponse(progress)
+
+
+@method_decorator(staff_member_required, name='dispatch')
+class ImportMultiVariationView(UploadMixin, TemplateView):
+    """Upload a file and import it on background (see `tasks.run_import`)."""
+    template_name = "cataragonario/import.html"
+    title = "Catalan diatopic import"
+
+    def post(self, request, *args, **kwargs):
+        form = self.get_upload_form()
+
+        if form.is_valid():
+            try:
+                input_file, _ = uploads.store_upload(form.cleaned_data['input_file'])
+            except ValidationError as e:
+                form.add_error('input_file', e)
+            else:
+                task = tasks.start_import(input_file)
+                return redirect("catalan-import-detail", pk=task.pk)
+
+        return self.render_to_response(self.get_context_data(form=form, **kwargs))
+
+    def get_context_data(self, **kwargs):
+        kwargs.setdefault('form', ValidatorForm())
+        context = super().get_context_data(**kwargs)
+        context['title'] = self.title
+        return context
+
+
+@method_decorator(staff_member_required, name='dispatch')
+class ImportTaskView(DetailView):
+    model = ImportTask
+    template_name = "cataragonario/import-task-detail.html"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update({
+            'title': "Import {}".format(self.object.pk),
+            'log_name': urllib.parse.quote_plus(self.object.log_file),
+        })
+        return context